@@ -0,0 +1,1100 @@
+"""
+Performance benchmarks for the assistant.
+Run one at a time, e.g.  python benchmarks.py tts --runs 10
+End-to-end without mic, network or speaker:  python benchmarks.py e2e [sessions.json ...]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+def _percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    idx = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[idx]
+
+
+def report(name, samples, unit="ms", scale=1000.0):
+    """Prints mean/p50/p95/p99/max of a list of durations given in seconds."""
+    if not samples:
+        print(f"{name:<40} no samples")
+        return
+    scaled = [s * scale for s in samples]
+    print(
+        f"{name:<40} n={len(scaled):<6} mean={statistics.mean(scaled):9.2f}{unit} "
+        f"p50={_percentile(scaled, 50):9.2f}{unit} p95={_percentile(scaled, 95):9.2f}{unit} "
+        f"p99={_percentile(scaled, 99):9.2f}{unit} max={max(scaled):9.2f}{unit}"
+    )
+
+
+# --- TTS: wake-to-first-audio ---
+def bench_tts(args):
+    import pyttsx3
+    import main
+
+    phrase = "Yes?"
+
+    # Old behaviour: fresh engine per call, then a hard 1 s sleep
+    first_audio, blocked = [], []
+    for _ in range(args.runs):
+        t0 = time.perf_counter()
+        started = []
+        engine = pyttsx3.init()
+        voices = engine.getProperty('voices')
+        if len(voices) > 1:
+            engine.setProperty('voice', voices[1].id)
+        engine.setProperty('rate', main.TTS_RATE)
+        engine.setProperty('volume', main.TTS_VOLUME)
+        engine.connect('started-utterance', lambda name: started.append(time.perf_counter()))
+        engine.say(phrase)
+        engine.runAndWait()
+        engine.stop()
+        del engine
+        time.sleep(1.0)
+        if started:
+            first_audio.append(started[0] - t0)
+        blocked.append(time.perf_counter() - t0)
+    report("legacy per-call engine: first audio", first_audio)
+    report("legacy per-call engine: blocked", blocked)
+
+    # New behaviour: one warm worker, fixed phrases served from the disk cache
+    service = main.SpeechService().start()
+    service._ready.wait()
+    deadline = time.time() + 30
+    while main.PhraseCache.key(phrase, service.voice_id) not in service.cache and time.time() < deadline:
+        time.sleep(0.1)
+
+    first_audio, blocked = [], []
+    for _ in range(args.runs):
+        t0 = time.perf_counter()
+        utt = service.say(phrase, main.PRIORITY_HIGH)
+        utt.wait()
+        if utt.latency is not None:
+            first_audio.append(utt.latency)
+        blocked.append(time.perf_counter() - t0)
+    report("speech service: first audio", first_audio)
+    report("speech service: blocked", blocked)
+
+
+# --- Wake word: local spotter over recorded WAV fixtures ---
+def bench_wake(args):
+    import main
+
+    spotter = main.WakeWordSpotter()
+    if not spotter.set_keyphrase(args.wake_word):
+        print("Local spotter unavailable (pocketsphinx missing or wake word not in dictionary).")
+        return
+
+    for path in args.paths:
+        hits = spotter.scan_wav(path)
+        print(f"{path}: {len(hits)} hit(s) at " + ", ".join(f"{h:.2f}s" for h in hits))
+
+    print(f"audio processed: {spotter.audio_seconds:.1f}s, CPU load: {spotter.cpu_load:.2%} of one core")
+    report("detection latency", spotter.latencies)
+
+
+# --- Intent router: routing time vs catalog size ---
+def _synthetic_songs(n, seed=7):
+    import random
+    rng = random.Random(seed)
+    vocab = [f"w{i}" for i in range(5000)]
+    songs = {}
+    while len(songs) < n:
+        title = " ".join(rng.choice(vocab) for _ in range(rng.randint(1, 4)))
+        songs[title] = f"https://www.youtube.com/watch?v={len(songs)}"
+    return songs
+
+
+def _legacy_route(command, songs, sites):
+    for site_key in sites:
+        if site_key in command and ("open" in command or "launch" in command or command.strip() == site_key):
+            return site_key
+    if "time" in command and "what" in command:
+        return "time"
+    for song_key in songs:
+        if song_key in command:
+            return song_key
+    return None
+
+
+def bench_router(args):
+    """What process_voice_command does per command: router.route, then the catalog if nothing matched."""
+    import os
+    import random
+    import tempfile
+    import main
+
+    rng = random.Random(1)
+    router = main.build_router()
+    with tempfile.TemporaryDirectory() as tmp:
+        db = main.Database(os.path.join(tmp, "router.db"))
+        catalog = main.MusicCatalog(db)
+        songs = {}
+        for n in (6, 1_000, 10_000, 100_000, 500_000):
+            new = {title: url for title, url in _synthetic_songs(n).items() if title not in songs}
+            t0 = time.perf_counter()
+            catalog.add_songs(new.items())
+            songs.update(new)
+            print(f"songs={len(catalog)}: catalog import took {time.perf_counter() - t0:.2f}s")
+
+            titles = list(songs)
+            commands = [
+                "open youtube", "what time is it", "tell me a joke about cats",
+                "can you please explain how rainbows form in the sky",
+            ] + [f"play {rng.choice(titles)}" for _ in range(16)]
+
+            samples = []
+            for _ in range(args.runs):
+                for command in commands:
+                    t0 = time.perf_counter()
+                    if router.route(command) is None:
+                        catalog.find_in_text(command)
+                    samples.append(time.perf_counter() - t0)
+            report(f"  route + find_in_text ({n} songs)", samples, unit="us", scale=1e6)
+
+            legacy = []
+            for command in commands[:4]:
+                t0 = time.perf_counter()
+                _legacy_route(command, songs, main.SITES)
+                legacy.append(time.perf_counter() - t0)
+            report(f"  legacy linear scan ({n} songs)", legacy, unit="us", scale=1e6)
+        db.close()
+
+
+# --- Music catalog: lookups against a large on-disk catalog ---
+def bench_catalog(args):
+    import os
+    import random
+    import tempfile
+    import main
+
+    rng = random.Random(3)
+    with tempfile.TemporaryDirectory() as tmp:
+        db = main.Database(os.path.join(tmp, "catalog.db"))
+        catalog = main.MusicCatalog(db)
+        for n in (1_000, 100_000, 500_000):
+            songs = _synthetic_songs(n)
+            t0 = time.perf_counter()
+            catalog.add_songs(songs.items())
+            print(f"songs={len(catalog)}: bulk import took {time.perf_counter() - t0:.2f}s")
+
+            titles = rng.sample(list(songs), 20)
+            exact, fuzzy = [], []
+            for _ in range(args.runs):
+                for title in titles:
+                    t0 = time.perf_counter()
+                    catalog.find_in_text(f"can you play {title} please")
+                    exact.append(time.perf_counter() - t0)
+                    typo = title[:-1] if len(title) > 4 else title
+                    t0 = time.perf_counter()
+                    catalog.search(typo)
+                    fuzzy.append(time.perf_counter() - t0)
+            report(f"  find_in_text ({n} songs)", exact)
+            report(f"  fuzzy search ({n} songs)", fuzzy)
+        db.close()
+
+
+# --- Database: concurrent register/login/update throughput ---
+def bench_db(args):
+    import os
+    import tempfile
+    import threading
+    import main
+
+    per_thread = args.runs * 20
+    with tempfile.TemporaryDirectory() as tmp:
+        db = main.Database(os.path.join(tmp, "users.db"))
+        latencies = {"register": [], "login": [], "update": []}
+        lock = threading.Lock()
+
+        def worker(t):
+            local = {name: [] for name in latencies}
+            emails = [f"user{t}_{i}@example.com" for i in range(per_thread)]
+            for email in emails:
+                t0 = time.perf_counter()
+                db.register_user(email, "pw", "First", "Last", 20, "Student", "College")
+                local["register"].append(time.perf_counter() - t0)
+            for email in emails:
+                t0 = time.perf_counter()
+                user = db.login_user(email, "pw")
+                local["login"].append(time.perf_counter() - t0)
+                t0 = time.perf_counter()
+                db.update_wake_word(user.id, "hey neon")
+                local["update"].append(time.perf_counter() - t0)
+            db.close()
+            with lock:
+                for name, samples in local.items():
+                    latencies[name].extend(samples)
+
+        threads = [threading.Thread(target=worker, args=(t,)) for t in range(args.threads)]
+        t0 = time.perf_counter()
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        elapsed = time.perf_counter() - t0
+
+        total = 3 * per_thread * args.threads
+        print(f"{args.threads} threads x {per_thread} users: {total} ops in {elapsed:.2f}s = {total / elapsed:.0f} ops/s")
+        for name, samples in latencies.items():
+            report(f"  {name}", samples)
+
+        rows = [(f"bulk{i}@example.com", "pw", "First", "Last", 20, "Employee", "Company")
+                for i in range(args.runs * 5000)]
+        t0 = time.perf_counter()
+        added = db.register_users(rows)
+        elapsed = time.perf_counter() - t0
+        print(f"bulk import: {added} users in {elapsed:.2f}s = {added / elapsed:.0f} users/s")
+        db.close()
+
+
+# --- UI: cold start and navigation latency (headless page) ---
+class HeadlessPage:
+    """Just enough of ft.Page to run main() without a window."""
+
+    def __init__(self):
+        self.views = []
+        self.route = "/"
+        self.overlay = []
+        self.on_route_change = None
+        self.on_view_pop = None
+
+    def go(self, route):
+        self.route = route
+        if self.on_route_change:
+            self.on_route_change(type("RouteChangeEvent", (), {"route": route})())
+
+    def update(self, *controls):
+        pass
+
+    def open(self, control):
+        pass
+
+
+def bench_ui(args):
+    import types
+
+    t0 = time.perf_counter()
+    import main
+    imported = time.perf_counter() - t0
+
+    page = HeadlessPage()
+    t0 = time.perf_counter()
+    main.main(page)
+    first_view = time.perf_counter() - t0
+    print(f"import main: {imported * 1000:.0f} ms, main() to login view: {first_view * 1000:.0f} ms")
+
+    # Don't start the microphone pipeline from the dashboard
+    main.state.pipeline = types.SimpleNamespace(status_control=None)
+    main.state.current_user = main.User(1, "bench@example.com", "Bench", "User", 20, "Student", "College", "hey neon")
+
+    routes = ["/", "/register", "/setup", "/dashboard"]
+    first, again = [], []
+    for route in routes:
+        t0 = time.perf_counter()
+        page.go(route)
+        first.append(time.perf_counter() - t0)
+    for _ in range(args.runs):
+        for route in routes:
+            t0 = time.perf_counter()
+            page.go(route)
+            again.append(time.perf_counter() - t0)
+    report("navigation, first visit (build)", first)
+    report("navigation, cached view", again)
+    main.state.perf_panel_gen += 1
+
+
+# --- End-to-end: scripted sessions with offline stand-ins ---
+# Everything below replaces a piece of hardware or a network service so the
+# whole voice pipeline runs on a plain Linux box: the microphone replays a
+# timeline of WAV fixtures (or synthetic speech bursts), the recognizer looks
+# up which scripted utterance it was handed, Gemini streams a canned reply,
+# speech "plays" for a time proportional to its length, and webbrowser.open /
+# subprocess.Popen only get recorded. Sessions with "echo" also feed that
+# speech back into the microphone, as laptop speakers do.
+E2E_SAMPLE_RATE = 16000
+E2E_LEAD_IN = 1.0            # silence before the first turn, for the noise floor to settle
+E2E_WAKE_TO_COMMAND = 1.5    # pause between the wake word and the command
+E2E_TURN_GAP = 10.0          # silence after a command, room for the reply
+E2E_TAIL = 8.0
+E2E_WORD_SECONDS = 0.35      # synthetic speech length per word
+E2E_STT_SECONDS = 0.30
+E2E_STREAM_FINISH_SHARE = 0.2  # a streaming recognizer has done most of the work by the end
+E2E_LLM_FIRST_CHUNK_SECONDS = 0.40
+E2E_LLM_CHUNK_SECONDS = 0.05
+E2E_LLM_SECONDS_PER_KTOKEN = 0.15  # extra wait for the first chunk per 1000 prompt tokens
+E2E_TTS_CHARS_PER_SECOND = 15.0
+E2E_ECHO_LEVEL = 1500        # amplitude of our own speech coming back through the mic
+
+E2E_SESSIONS = [
+    {"name": "local commands", "turns": [
+        {"command": "what time is it"},
+        {"command": "what is the date today"},
+        {"command": "open youtube"},
+        {"command": "open calculator"},
+    ]},
+    {"name": "music", "turns": [
+        {"command": "play believer"},
+        {"command": "play shape of you"},
+        {"command": "play some song nobody has heard of"},
+    ]},
+    {"name": "gemini", "turns": [
+        {"command": "who wrote the odyssey"},
+        {"command": "why is the sky blue"},
+        {"command": "who wrote the odyssey"},
+    ]},
+    # The user waits for "Yes?" to finish and then pauses before talking,
+    # while the mic hears the prompt from the speakers
+    {"name": "speaker echo", "echo": True, "turns": [
+        {"command": "what time is it", "pause": 3.0},
+        {"command": "open youtube", "pause": 3.0},
+    ]},
+]
+
+
+def load_pcm(path, sample_rate=E2E_SAMPLE_RATE):
+    """A WAV fixture as 16-bit mono PCM at sample_rate."""
+    import wave
+    import main
+
+    with wave.open(path, "rb") as wf:
+        width, channels, rate = wf.getsampwidth(), wf.getnchannels(), wf.getframerate()
+        pcm = wf.readframes(wf.getnframes())
+    return main.to_pcm16(pcm, width, channels, rate, sample_rate)
+
+
+class Timeline:
+    """
+    The audio a session's microphone will hear, plus which transcript each
+    stretch of it belongs to. Low-level noise runs under everything so any
+    slice of the recording can be located again byte for byte.
+    """
+
+    def __init__(self, sample_rate=E2E_SAMPLE_RATE, seed=0):
+        import random
+        self.sample_rate = sample_rate
+        self.segments = []   # (start_byte, end_byte, transcript)
+        self._rng = random.Random(seed)
+        self._pcm = bytearray()
+
+    @property
+    def pcm(self):
+        return bytes(self._pcm)
+
+    @property
+    def seconds(self):
+        return len(self._pcm) / 2.0 / self.sample_rate
+
+    def _append(self, samples, transcript=None):
+        from array import array
+        start = len(self._pcm)
+        self._pcm += array("h", samples).tobytes()
+        if transcript is not None:
+            self.segments.append((start, len(self._pcm), transcript))
+
+    def silence(self, seconds):
+        rand = self._rng.randint
+        self._append(rand(-8, 8) for _ in range(int(seconds * self.sample_rate)))
+
+    def speech(self, transcript, wav=None):
+        """Appends transcript, spoken by a WAV fixture or as a tone burst."""
+        import math
+        if wav:
+            from array import array
+            recorded = array("h")
+            recorded.frombytes(load_pcm(wav, self.sample_rate))
+            self._append(recorded, transcript)
+            return
+        rand = self._rng.randint
+        n = int(max(1, len(transcript.split())) * E2E_WORD_SECONDS * self.sample_rate)
+        step = 2 * math.pi * (180 + 20 * (len(self.segments) % 10)) / self.sample_rate
+        self._append((int(3000 * math.sin(i * step)) + rand(-8, 8) for i in range(n)), transcript)
+
+    def transcript_of(self, raw):
+        """The scripted transcript that overlaps the recorded slice raw the most."""
+        if len(raw) < 2:
+            return None
+        offset = bytes(self._pcm).find(raw[:960])
+        if offset < 0:
+            return None
+        end = offset + len(raw)
+        best, best_overlap = None, 0
+        for seg_start, seg_end, transcript in self.segments:
+            overlap = min(end, seg_end) - max(offset, seg_start)
+            if overlap > best_overlap:
+                best, best_overlap = transcript, overlap
+        return best
+
+
+def session_timeline(session, wake_word):
+    timeline = Timeline()
+    timeline.silence(E2E_LEAD_IN)
+    for turn in session["turns"]:
+        timeline.speech(wake_word, turn.get("wake_wav"))
+        timeline.silence(turn.get("pause", E2E_WAKE_TO_COMMAND))
+        timeline.speech(turn["command"], turn.get("wav"))
+        timeline.silence(turn.get("gap", E2E_TURN_GAP))
+    timeline.silence(E2E_TAIL)
+    return timeline
+
+
+class ReplayMic:
+    """
+    Microphone stand-in for AudioCapture: replays a Timeline in real time
+    (times speed). echo, if given, is polled per chunk and while it returns
+    True a tone is mixed in, for the assistant's own speech.
+    """
+    CHUNK = 480
+
+    def __init__(self, timeline, speed=1.0, echo=None):
+        self.pcm = timeline.pcm
+        self.sample_rate = timeline.sample_rate
+        self.speed = speed
+        self.echo = echo
+        self.stream = self
+        self._pos = 0
+        self._t0 = None
+
+    def __enter__(self):
+        self._t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def read(self, n):
+        data = self.pcm[self._pos * 2:(self._pos + n) * 2]
+        if data and self.echo is not None and self.echo():
+            data = self._mix_echo(data)
+        self._pos += n
+        delay = self._t0 + self._pos / float(self.sample_rate) / self.speed - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        return data
+
+    def _mix_echo(self, data):
+        import math
+        from array import array
+        samples = array("h")
+        samples.frombytes(data)
+        step = 2 * math.pi * 440 / self.sample_rate
+        for i in range(len(samples)):
+            mixed = samples[i] + int(E2E_ECHO_LEVEL * math.sin((self._pos + i) * step))
+            samples[i] = max(-32768, min(32767, mixed))
+        return samples.tobytes()
+
+
+class ReplayStream:
+    """Streaming stand-in: the partial grows word by word with the share of the segment heard."""
+
+    def __init__(self, recognizer):
+        self.recognizer = recognizer
+        self.timeline = recognizer.timeline
+        self.raw = bytearray()
+        self.offset = None
+
+    def feed(self, frame):
+        self.raw += frame
+        if self.offset is None and len(self.raw) >= 960:
+            offset = self.timeline.pcm.find(bytes(self.raw[:960]))
+            self.offset = offset if offset >= 0 else -1
+        if self.offset is None or self.offset < 0:
+            return ""
+        end = self.offset + len(self.raw)
+        for seg_start, seg_end, transcript in self.timeline.segments:
+            if seg_start < end and self.offset < seg_end:
+                words = transcript.split()
+                heard = (min(end, seg_end) - seg_start) / float(seg_end - seg_start)
+                return " ".join(words[:int(len(words) * heard)])
+        return ""
+
+    def finish(self):
+        import speech_recognition as sr
+        self.recognizer.calls += 1
+        time.sleep(self.recognizer.latency * E2E_STREAM_FINISH_SHARE)
+        transcript = self.timeline.transcript_of(bytes(self.raw))
+        if transcript is None:
+            raise sr.UnknownValueError()
+        return transcript
+
+
+class ReplayRecognizer:
+    """STT backend stand-in: answers with the scripted transcript of the audio it gets."""
+    name = "replay"
+    local = True
+    streaming = False
+
+    def __init__(self, timeline, latency=E2E_STT_SECONDS, streaming=False):
+        self.timeline = timeline
+        self.latency = latency
+        self.streaming = streaming
+        self.calls = 0
+
+    def open_stream(self, sample_rate):
+        return ReplayStream(self) if self.streaming else None
+
+    def transcribe(self, audio):
+        import speech_recognition as sr
+        self.calls += 1
+        time.sleep(self.latency)
+        transcript = self.timeline.transcript_of(audio.get_raw_data())
+        if transcript is None:
+            raise sr.UnknownValueError()
+        return transcript
+
+
+class CloudOnlySpotter:
+    """Keeps the local KWS spotter out of the way so wake words go through the recognizer."""
+    latencies = []
+
+    def set_keyphrase(self, phrase):
+        return False
+
+
+class OfflineGemini:
+    """Stand-in for the google.generativeai module: canned replies streamed in chunks."""
+
+    def __init__(self, first_chunk=E2E_LLM_FIRST_CHUNK_SECONDS, per_chunk=E2E_LLM_CHUNK_SECONDS,
+                 per_ktoken=E2E_LLM_SECONDS_PER_KTOKEN):
+        self.first_chunk = first_chunk
+        self.per_chunk = per_chunk
+        self.per_ktoken = per_ktoken
+        self.requests = []
+
+    def configure(self, **kwargs):
+        pass
+
+    def GenerativeModel(self, name, system_instruction=None):
+        return self
+
+    def generate_content(self, prompt, stream=False):
+        import types
+        self.requests.append(prompt)
+        # A conversation comes as a list of turns; the question is the last one
+        turns = prompt if isinstance(prompt, list) else [{"role": "user", "parts": [prompt]}]
+        question = turns[-1]["parts"][0]
+        prompt_tokens = sum(len(part) for turn in turns for part in turn["parts"]) / 4.0
+        topic = " ".join(question.split()[:12])
+        reply = f"Here is a short answer about {topic}. It is made up for the benchmark."
+        words = reply.split(" ")
+        chunks = [" ".join(words[i:i + 4]) + " " for i in range(0, len(words), 4)]
+
+        def stream_chunks():
+            time.sleep(self.first_chunk + self.per_ktoken * prompt_tokens / 1000.0)
+            for i, text in enumerate(chunks):
+                if i:
+                    time.sleep(self.per_chunk)
+                yield types.SimpleNamespace(text=text)
+        return stream_chunks() if stream else types.SimpleNamespace(text=reply)
+
+    def count_tokens(self, contents):
+        import types
+        return types.SimpleNamespace(total_tokens=len(str(contents)) // 4)
+
+    def embed_content(self, model, content):
+        import hashlib
+        digest = hashlib.sha256(content.encode("utf-8")).digest()
+        return {"embedding": [b / 255.0 for b in digest]}
+
+
+class SideEffects:
+    """Records what would have been opened or launched instead of doing it."""
+
+    def __init__(self):
+        self.opened = []
+        self.launched = []
+
+    def open(self, url, *args, **kwargs):
+        self.opened.append(url)
+        return True
+
+    def Popen(self, args, *rest, **kwargs):
+        import types
+        self.launched.append(args)
+        return types.SimpleNamespace(pid=0, poll=lambda: 0, wait=lambda timeout=None: 0)
+
+
+def offline_speech_class(main):
+    class OfflineSpeech(main.SpeechService):
+        """SpeechService whose "playback" is a wait proportional to the text length."""
+        speed = 1.0
+        playing = False
+
+        def _init_engine(self):
+            self.voice_id = "offline"
+
+        def _synthesize_next(self):
+            pass
+
+        def _speak(self, utt):
+            utt.mark_started()
+            self.playing = True
+            try:
+                utt._cancel.wait(len(utt.text) / E2E_TTS_CHARS_PER_SECOND / self.speed)
+            finally:
+                self.playing = False
+    return OfflineSpeech
+
+
+class HeadlessStatus:
+    """Stand-in for the dashboard's status ft.Text; remembers every value shown."""
+
+    def __init__(self):
+        self.color = None
+        self.shown = []
+
+    @property
+    def value(self):
+        return self.shown[-1] if self.shown else ""
+
+    @value.setter
+    def value(self, text):
+        self.shown.append(text)
+
+
+def run_session(main, session, args, tmp):
+    import asyncio
+    from unittest import mock
+
+    wake_word = session.get("wake_word", args.wake_word)
+    timeline = session_timeline(session, wake_word)
+    # Every simulated delay runs speed times faster, like the audio; reported
+    # times are scaled back up to what they would be in real time
+    speed = args.speed
+    recognizer = ReplayRecognizer(timeline, args.stt_ms / 1000.0 / speed, streaming=args.streaming)
+    gemini = OfflineGemini(E2E_LLM_FIRST_CHUNK_SECONDS / speed, E2E_LLM_CHUNK_SECONDS / speed,
+                           E2E_LLM_SECONDS_PER_KTOKEN / speed)
+    effects = SideEffects()
+
+    main.tracer = main.Tracer()
+    main.speculator = main.Speculator()
+    main.genai = gemini
+    main._llm_model = None
+    speech_class = offline_speech_class(main)
+    speech_class.speed = speed
+    main.speech = speech_class(cache=main.PhraseCache(os.path.join(tmp, "tts")))
+    main.state.is_listening = True
+    main.state.wake_word = wake_word
+
+    page, status = HeadlessPage(), HeadlessStatus()
+    echo = (lambda: main.speech.playing) if session.get("echo") else None
+    capture = main.AudioCapture(lambda: ReplayMic(timeline, speed, echo))
+    pipeline = main.VoicePipeline(page, status, capture, stt=recognizer)
+    if not args.local_wake:
+        pipeline.spotter = CloudOnlySpotter()
+
+    with mock.patch.object(main, "API_KEY", "offline"), \
+            mock.patch.object(main.webbrowser, "open", effects.open), \
+            mock.patch.object(main.subprocess, "Popen", effects.Popen):
+        t0 = time.perf_counter()
+        asyncio.run(pipeline.run())
+        elapsed = (time.perf_counter() - t0) * speed
+
+    samples = {stage: [v * speed for v in values] for stage, values in main.tracer.samples().items()}
+    done = len(samples.get("interaction", []))
+    print(f"\n== {session['name']}: {done}/{len(session['turns'])} commands completed in {elapsed:.1f}s "
+          f"({timeline.seconds:.1f}s of audio), {done / elapsed * 60:.1f} commands/min, "
+          f"{len(session['turns']) - done} cut short by the next wake word")
+    print(f"   recognizer calls: {recognizer.calls}, Gemini requests: {len(gemini.requests)}, "
+          f"opened: {len(effects.opened)}, launched: {len(effects.launched)}, "
+          f"status updates: {len(status.shown)}")
+    if args.streaming:
+        spec = main.speculator.stats()
+        print(f"   speculation: routes reused {spec['route_hit_rate']:.0%}, Gemini {spec['hits']}/{spec['requests']} "
+              f"tentative requests kept ({spec['hit_rate']:.0%}), {spec['cancelled']} cancelled, "
+              f"{spec['avg_saved_ms'] * speed:.0f} ms head start per kept request")
+    for stage, values in sorted(samples.items()):
+        report(f"  {stage}", values)
+    return samples
+
+
+def bench_e2e(args):
+    import json
+    import tempfile
+    import main
+
+    sessions = []
+    for path in args.paths:
+        with open(path, encoding="utf-8") as f:
+            loaded = json.load(f)
+        sessions.extend(loaded if isinstance(loaded, list) else [loaded])
+    sessions = sessions or E2E_SESSIONS
+
+    with tempfile.TemporaryDirectory() as tmp:
+        main.db = main.Database(os.path.join(tmp, "e2e.db"))
+        main.catalog = main.MusicCatalog(main.db)
+        main.response_cache = main.ResponseCache(main.db)
+        main.conversations = main.ConversationStore(main.db)
+        main.state.current_user = main.User(1, "bench@example.com", "Bench", "User", 20, "Student", "College",
+                                            args.wake_word)
+        totals = {}
+        for session in sessions:
+            for stage, values in run_session(main, session, args, tmp).items():
+                totals.setdefault(stage, []).extend(values)
+        print("\n== all sessions")
+        for stage, values in sorted(totals.items()):
+            report(f"  {stage}", values)
+        main.db.close()
+
+
+# --- Server mode: N concurrent browser sessions ---
+SERVER_COMMANDS = [
+    "what time is it", "what is the date today", "open youtube", "play believer",
+    "who wrote the odyssey", "why is the sky blue", "how do vaccines work", "what is a black hole",
+]
+
+
+class LoadTestPage(HeadlessPage):
+    """HeadlessPage for one simulated browser tab."""
+
+    def __init__(self, session_id):
+        super().__init__()
+        self.session_id = session_id
+        self.launched = []
+
+    def launch_url(self, url):
+        self.launched.append(url)
+
+
+def offline_wav(text, chars_per_second=E2E_TTS_CHARS_PER_SECOND):
+    """Stand-in for synthesize_wav: silence as long as the text would take to say."""
+    import io
+    import wave
+
+    time.sleep(len(text) * 0.001)
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as wf:
+        wf.setnchannels(1)
+        wf.setsampwidth(2)
+        wf.setframerate(E2E_SAMPLE_RATE)
+        wf.writeframes(bytes(2 * int(E2E_SAMPLE_RATE * len(text) / chars_per_second)))
+    return buf.getvalue()
+
+
+def bench_server(args):
+    import random
+    import tempfile
+    import threading
+    from unittest import mock
+    import main
+
+    gemini = OfflineGemini()
+    latencies, lock = [], threading.Lock()
+    counts = {"commands": 0, "rejected": 0, "sessions_rejected": 0}
+
+    def client(i):
+        rng = random.Random(i)
+        page = LoadTestPage(f"session-{i}")
+        try:
+            session = main.sessions.open(page.session_id)
+        except main.Overloaded:
+            with lock:
+                counts["sessions_rejected"] += 1
+            return
+        session.speaker = main.WebSpeaker(page)
+        session.current_user = main.User(i + 1, f"user{i}@example.com", "Load", "Test", 20, "Student", "College")
+        status = HeadlessStatus()
+        try:
+            for _ in range(args.runs):
+                time.sleep(rng.uniform(0, 2 * args.think_ms / 1000.0))
+                t0 = time.perf_counter()
+                try:
+                    main.submit_command(session, rng.choice(SERVER_COMMANDS), page, status).result()
+                except main.Overloaded:
+                    with lock:
+                        counts["rejected"] += 1
+                    continue
+                with lock:
+                    latencies.append(time.perf_counter() - t0)
+                    counts["commands"] += 1
+        finally:
+            main.sessions.close(page.session_id)
+
+    with tempfile.TemporaryDirectory() as tmp, \
+            mock.patch.object(main, "SERVER_MODE", True), \
+            mock.patch.object(main, "API_KEY", "offline"), \
+            mock.patch.object(main, "genai", gemini), \
+            mock.patch.object(main, "synthesize_wav", offline_wav):
+        main.db = main.Database(os.path.join(tmp, "server.db"))
+        main.catalog = main.MusicCatalog(main.db)
+        main.response_cache = main.ResponseCache(main.db)
+        main.conversations = main.ConversationStore(main.db)
+        main.catalog.sync_music_library()
+        main._llm_model = None
+        main.tracer = main.Tracer()
+        main.sessions = main.SessionManager(args.max_sessions or args.sessions)
+
+        clients = [threading.Thread(target=client, args=(i,)) for i in range(args.sessions)]
+        t0 = time.perf_counter()
+        for t in clients:
+            t.start()
+        for t in clients:
+            t.join()
+        elapsed = time.perf_counter() - t0
+
+        print(f"{args.sessions} sessions x {args.runs} commands: {counts['commands']} done in {elapsed:.1f}s "
+              f"= {counts['commands'] / elapsed:.1f} commands/s; {counts['rejected']} rejected (Overloaded), "
+              f"{counts['sessions_rejected']} sessions turned away")
+        report("command latency (submit to reply queued)", latencies)
+        samples = main.tracer.samples()
+        for stage in ("queue.command", "act", "llm.first_sentence", "llm.cache_hit", "tts.first_audio"):
+            report(f"  {stage}", samples.get(stage, []))
+        for pool in main.POOLS:
+            print(f"  pool {pool.name:<8} " + ", ".join(f"{k}={v}" for k, v in pool.stats().items()))
+        main.db.close()
+
+
+# --- Conversation context: request size vs reply latency per token budget ---
+CONTEXT_QUESTIONS = [
+    "who wrote pride and prejudice",
+    "when was she born",
+    "what else did she write",
+    "which of those is the most famous",
+    "is it a long book",
+    "who is the main character",
+    "why is he called proud",
+    "how does it end",
+]
+
+
+def bench_context(args):
+    import contextlib
+    import tempfile
+    from unittest import mock
+    import main
+
+    online = args.online and main.API_KEY
+    print("Gemini: " + ("online" if online else "offline stand-in (latency grows with prompt size, modelled)"))
+    for budget in [int(b) for b in args.budgets.split(",")]:
+        with tempfile.TemporaryDirectory() as tmp, contextlib.ExitStack() as stack:
+            if not online:
+                stack.enter_context(mock.patch.object(main, "genai", OfflineGemini()))
+                stack.enter_context(mock.patch.object(main, "API_KEY", "offline"))
+            main._llm_model = None
+            main.tracer = main.Tracer()
+            main.db = main.Database(os.path.join(tmp, "context.db"))
+            store = main.ConversationStore(main.db, budget=budget)
+            conversation = store.get(1)
+
+            request_tokens, first, total = [], [], []
+            for i in range(args.turns):
+                question = CONTEXT_QUESTIONS[i % len(CONTEXT_QUESTIONS)]
+                history, tokens = conversation.history()
+                request_tokens.append(tokens + main.estimate_tokens(question))
+                t0 = time.perf_counter()
+                sentences = []
+                for sentence in main.stream_reply(question, None, history):
+                    if not sentences:
+                        first.append(time.perf_counter() - t0)
+                    sentences.append(sentence)
+                total.append(time.perf_counter() - t0)
+                conversation.add(question, " ".join(sentences))
+
+            print(f"\n== budget {budget} tokens: request {statistics.mean(request_tokens):.0f} tokens on average, "
+                  f"max {max(request_tokens)}")
+            report("  first sentence", first)
+            report("  full reply", total)
+            report("  summarize (background)", main.tracer.samples().get("llm.summarize", []))
+            main.db.close()
+
+
+# --- Speech to text: real-time factor and word error rate per backend ---
+def word_error_rate(reference, hypothesis):
+    """(word edits, reference words) between two transcripts."""
+    ref, hyp = reference.lower().split(), hypothesis.lower().split()
+    row = list(range(len(hyp) + 1))
+    for i, r in enumerate(ref, 1):
+        prev, row[0] = row[0], i
+        for j, h in enumerate(hyp, 1):
+            prev, row[j] = row[j], min(row[j] + 1, row[j - 1] + 1, prev + (r != h))
+    return row[-1], len(ref)
+
+
+def bench_stt(args):
+    """
+    Fixtures are WAV files with the expected transcript next to them in a
+    .txt file of the same name (command.wav + command.txt).
+    """
+    import speech_recognition as sr
+    import main
+
+    fixtures = []
+    for path in args.paths:
+        with open(os.path.splitext(path)[0] + ".txt", encoding="utf-8") as f:
+            pcm = load_pcm(path)
+            fixtures.append((path, sr.AudioData(pcm, E2E_SAMPLE_RATE, 2), len(pcm) / 2.0 / E2E_SAMPLE_RATE,
+                             f.read().strip()))
+    if not fixtures:
+        print("usage: benchmarks.py stt fixtures/*.wav  (each with a matching .txt transcript)")
+        return
+
+    for name in args.backends.split(","):
+        backend = main.get_stt_backend(name)
+        if not backend.available():
+            print(f"\n== {name}: not available (package or model missing)")
+            continue
+        t0 = time.perf_counter()
+        backend.load()
+        print(f"\n== {name}: loaded in {(time.perf_counter() - t0) * 1000:.0f} ms")
+
+        latencies, rtfs, edits, words, failures = [], [], 0, 0, 0
+        for _ in range(args.runs):
+            for path, audio, seconds, expected in fixtures:
+                t0 = time.perf_counter()
+                try:
+                    heard = backend.transcribe(audio)
+                except sr.UnknownValueError:
+                    heard = ""
+                except sr.RequestError as e:
+                    failures += 1
+                    print(f"   {path}: request failed ({e})")
+                    continue
+                elapsed = time.perf_counter() - t0
+                latencies.append(elapsed)
+                rtfs.append(elapsed / seconds)
+                e, n = word_error_rate(expected, heard)
+                edits += e
+                words += n
+        report("  transcribe", latencies)
+        report("  real-time factor", rtfs, unit="x", scale=1.0)
+        if words:
+            print(f"  word error rate: {edits / words:.1%} over {words} words, {failures} failed requests")
+
+
+# --- VAD: endpointing on synthetic energy tracks ---
+VAD_FRAME_SECONDS = 0.03
+VAD_FLOOR = 100
+VAD_STEADY = VAD_FLOOR * 10 ** (8 / 20.0)  # 8 dB above the floor
+VAD_CASES = [
+    # name, [(seconds, energy), ...]; anything above VAD_FLOOR is speech
+    ("loud onset, then steady speech 8 dB above the floor",
+     [(1.0, VAD_FLOOR), (0.3, 400), (3.0, VAD_STEADY), (1.0, VAD_FLOOR)]),
+    ("normal onset, then 4 s of steady speech 8 dB above the floor",
+     [(1.0, VAD_FLOOR), (0.2, 320), (4.0, VAD_STEADY), (1.0, VAD_FLOOR)]),
+    ("two utterances, the second starts from the same floor",
+     [(1.0, VAD_FLOOR), (0.3, 400), (1.5, VAD_STEADY), (1.0, VAD_FLOOR),
+      (0.3, 400), (1.5, VAD_STEADY), (1.0, VAD_FLOOR)]),
+]
+
+
+def bench_vad(args):
+    """Fails if steady speech a little above the noise floor is cut off or the floor creeps up to it."""
+    import main
+
+    failures = 0
+    for name, track in VAD_CASES:
+        noise = main.NoiseFloor()
+        vad = main.Endpointer(noise, VAD_FRAME_SECONDS)
+        index, ends, spans = 0, [], []
+        for seconds, energy in track:
+            frames = int(round(seconds / VAD_FRAME_SECONDS))
+            if energy > VAD_FLOOR:
+                if spans and spans[-1][1] == index:
+                    spans[-1][1] += frames
+                else:
+                    spans.append([index, index + frames])
+            for _ in range(frames):
+                noise.update(energy)  # as the capture thread does, before the endpointer sees the frame
+                if vad.push(index, energy) == vad.END:
+                    ends.append(index)
+                    vad = main.Endpointer(noise, VAD_FRAME_SECONDS)
+                index += 1
+        # Each utterance must end after its last voiced frame, within the hangover (+ a frame)
+        slack = vad.hangover_frames + 1
+        ok = len(ends) == len(spans) and all(end - slack <= last <= end for end, (_, last) in zip(ends, spans))
+        failures += not ok
+        print(f"{'OK  ' if ok else 'FAIL'} {name}: END at frames {ends}, speech ends at "
+              f"{[last for _, last in spans]}, floor now {noise.level:.0f}")
+    if failures:
+        raise SystemExit(f"FAIL: {failures} of {len(VAD_CASES)} VAD cases")
+
+
+# --- Startup: cold import time ---
+STARTUP_BUDGET_MS = 500.0
+_TIMED_IMPORT = "import time; t = time.perf_counter(); import main; {extra}print(time.perf_counter() - t)"
+
+
+def _cold_start(extra=""):
+    """Seconds for `import main` (plus extra) in a fresh interpreter."""
+    out = subprocess.run(
+        [sys.executable, "-c", _TIMED_IMPORT.format(extra=extra)],
+        cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True,
+    )
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+def import_profile(top=15):
+    """Runs python -X importtime on main and returns the slowest (cumulative_us, module) rows."""
+    out = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True,
+    )
+    rows = []
+    for line in out.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, module = line[len("import time:"):].split("|")
+        rows.append((int(cumulative), module.rstrip()))
+    rows.sort(reverse=True)
+    return rows[:top]
+
+
+def bench_startup(args):
+    print("slowest imports (python -X importtime, cumulative):")
+    for cumulative, module in import_profile():
+        print(f"  {cumulative / 1000:9.1f} ms  {module}")
+
+    lazy = [_cold_start() for _ in range(args.runs)]
+    eager = [_cold_start("main.warm_up(); ") for _ in range(args.runs)]
+    report("import main (lazy startup)", lazy)
+    report("import main + warm_up (eager startup)", eager)
+
+    p50 = _percentile(lazy, 50) * 1000
+    if p50 > args.budget_ms:
+        raise SystemExit(f"FAIL: cold import p50 {p50:.0f} ms is over the {args.budget_ms:.0f} ms budget")
+    print(f"OK: cold import p50 {p50:.0f} ms (budget {args.budget_ms:.0f} ms)")
+
+
+BENCHMARKS = {
+    "tts": bench_tts,
+    "wake": bench_wake,
+    "router": bench_router,
+    "catalog": bench_catalog,
+    "db": bench_db,
+    "ui": bench_ui,
+    "startup": bench_startup,
+    "e2e": bench_e2e,
+    "stt": bench_stt,
+    "server": bench_server,
+    "context": bench_context,
+    "vad": bench_vad,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("name", choices=sorted(BENCHMARKS))
+    parser.add_argument("paths", nargs="*", help="input files (WAV fixtures etc.)")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--wake-word", default="hey alexa")
+    parser.add_argument("--budget-ms", type=float, default=STARTUP_BUDGET_MS, help="startup: fail above this p50")
+    parser.add_argument("--speed", type=float, default=1.0, help="e2e: replay audio this many times faster")
+    parser.add_argument("--stt-ms", type=float, default=E2E_STT_SECONDS * 1000, help="e2e: simulated recognizer latency")
+    parser.add_argument("--local-wake", action="store_true", help="e2e: use the pocketsphinx spotter on WAV fixtures")
+    parser.add_argument("--streaming", action="store_true",
+                        help="e2e: streaming recognizer with partial transcripts (speculative dispatch)")
+    parser.add_argument("--backends", default="google,vosk", help="stt: comma separated backends to compare")
+    parser.add_argument("--sessions", type=int, default=20, help="server: concurrent simulated sessions")
+    parser.add_argument("--max-sessions", type=int, default=0, help="server: admission limit (default: --sessions)")
+    parser.add_argument("--think-ms", type=float, default=500.0, help="server: mean pause between a session's commands")
+    parser.add_argument("--budgets", default="0,200,400,800,1600", help="context: token budgets to compare")
+    parser.add_argument("--turns", type=int, default=24, help="context: questions per conversation")
+    parser.add_argument("--online", action="store_true", help="context: ask the real Gemini (needs GEMINI_API_KEY)")
+    args = parser.parse_args()
+    BENCHMARKS[args.name](args)
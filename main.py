@@ -1,306 +1,3823 @@
-import flet as ft
 import sqlite3
 import threading
-import speech_recognition as sr
-import google.generativeai as genai
 import os
 import webbrowser
 from dotenv import load_dotenv
 import time
-import pyttsx3 
 import subprocess 
 import datetime   
+import asyncio
+import concurrent.futures
+import importlib.util
+import csv
+import json
+import io
+import base64
+import difflib
+import math
+import re
+import hashlib
+import heapq
+import itertools
+import queue
+import shutil
+import tempfile
+import wave
+from array import array
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
 
-# IMPORT YOUR MUSIC LIBRARY
 try:
-    from musicLibrary import music
+    import winsound
 except ImportError:
-    music = {} 
-    print("WARNING: musicLibrary.py not found.")
+    winsound = None
+
+
+# --- LAZY IMPORTS ---
+# flet, speech_recognition, google.generativeai and pyttsx3 together cost
+# seconds of import time. They load on first attribute access instead, and
+# warm_up() touches them in the background once the login screen is up.
+class LazyModule:
+    """Stand-in for a module that is imported the first time it is used."""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    self._module = importlib.import_module(self._name)
+        return self._module
+
+    @property
+    def loaded(self):
+        return self._module is not None
+
+    def __getattr__(self, attr):
+        if attr.startswith("__") and attr.endswith("__"):
+            raise AttributeError(attr)
+        return getattr(self.load(), attr)
+
+    def __repr__(self):
+        return f"<lazy module '{self._name}'{' (loaded)' if self.loaded else ''}>"
+
+
+ft = LazyModule("flet")
+sr = LazyModule("speech_recognition")
+genai = LazyModule("google.generativeai")
+pyttsx3 = LazyModule("pyttsx3")
+
+SphinxDecoder = None
+_sphinx_checked = False
+
+
+def load_sphinx():
+    """Imports pocketsphinx on first use. Returns its Decoder class or None."""
+    global SphinxDecoder, _sphinx_checked
+    if not _sphinx_checked:
+        try:
+            from pocketsphinx import Decoder as SphinxDecoder
+        except ImportError:
+            SphinxDecoder = None
+        _sphinx_checked = True
+    return SphinxDecoder
+
 
 # --- CONFIGURATION ---
 load_dotenv()
 API_KEY = os.getenv("GEMINI_API_KEY")
 
-if API_KEY:
-    genai.configure(api_key=API_KEY)
-else:
-    print("WARNING: GEMINI_API_KEY not found in .env file.")
+if not API_KEY:
+    print("WARNING: GEMINI_API_KEY not found in .env file.")
+
+_genai_configured = False
+
+
+def configure_genai():
+    """genai.configure() on first use; importing the SDK alone takes a while."""
+    global _genai_configured
+    if not _genai_configured and API_KEY:
+        genai.configure(api_key=API_KEY)
+        _genai_configured = True
+    return _genai_configured
+
+# --- LATENCY TRACING ---
+TRACE_MAX_SAMPLES = 1024      # per stage, for the live percentiles
+TRACE_MAX_WINDOW_SAMPLES = 8192  # per stage and rollup window; batch runs never roll up
+TRACE_MAX_EVENTS = 10000      # spans kept for Chrome trace export
+METRICS_ROLLUP_SECONDS = 60
+
+
+def _percentiles(samples):
+    ordered = sorted(samples)
+    n = len(ordered)
+
+    def pick(p):
+        return ordered[min(n - 1, int(p * n))]
+    return {"count": n, "p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "max": ordered[-1]}
+
+
+class Tracer:
+    """
+    Per-interaction, per-stage timings on the monotonic clock. Keeps a bounded
+    window of samples per stage for p50/p95/p99, rolls them up into the
+    stage_metrics table every minute and can dump all spans as a Chrome trace
+    (load it in chrome://tracing or ui.perfetto.dev).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._samples = {}
+        self._window = {}  # stage: [count, latest samples] since the last rollup
+        self._events = deque(maxlen=TRACE_MAX_EVENTS)
+        self._origin_ns = time.perf_counter_ns()
+        self._rollup_thread = None
+        self._rollup_lock = threading.Lock()
+
+    def new_interaction(self):
+        return next(self._ids)
+
+    def record(self, stage, start_ns, end_ns, trace_id=None):
+        seconds = (end_ns - start_ns) / 1e9
+        with self._lock:
+            self._samples.setdefault(stage, deque(maxlen=TRACE_MAX_SAMPLES)).append(seconds)
+            window = self._window.get(stage)
+            if window is None:
+                window = self._window[stage] = [0, deque(maxlen=TRACE_MAX_WINDOW_SAMPLES)]
+            window[0] += 1
+            window[1].append(seconds)
+            self._events.append((stage, start_ns, end_ns, trace_id, threading.get_ident()))
+
+    def observe(self, stage, seconds, trace_id=None):
+        """Records a duration that ended just now."""
+        end_ns = time.perf_counter_ns()
+        self.record(stage, end_ns - int(seconds * 1e9), end_ns, trace_id)
+
+    @contextmanager
+    def stage(self, name, trace_id=None):
+        start_ns = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.record(name, start_ns, time.perf_counter_ns(), trace_id)
+
+    def samples(self):
+        """{stage: [seconds, ...]} for the recent samples of every stage."""
+        with self._lock:
+            return {stage: list(values) for stage, values in self._samples.items() if values}
+
+    def snapshot(self):
+        """{stage: {count, p50, p95, p99, max}} in seconds over the recent samples."""
+        return {stage: _percentiles(values) for stage, values in sorted(self.samples().items())}
+
+    # --- persistence ---
+    def start_rollup(self, db, interval=METRICS_ROLLUP_SECONDS):
+        # Two dashboards can open at the same moment
+        with self._rollup_lock:
+            if self._rollup_thread is not None:
+                return
+            conn = db.conn
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS stage_metrics (
+                    window_start REAL,
+                    stage TEXT,
+                    count INTEGER,
+                    p50_ms REAL,
+                    p95_ms REAL,
+                    p99_ms REAL,
+                    max_ms REAL,
+                    PRIMARY KEY (window_start, stage)
+                )
+            """)
+            conn.commit()
+            self._rollup_thread = threading.Thread(
+                target=self._rollup_loop, args=(db, interval), name="metrics", daemon=True)
+            self._rollup_thread.start()
+
+    def _rollup_loop(self, db, interval):
+        while True:
+            window_start = time.time()
+            time.sleep(interval)
+            try:
+                self.rollup(db, window_start)
+            except Exception as e:
+                print(f"Metrics Error: {e}")
+
+    def rollup(self, db, window_start):
+        with self._lock:
+            window, self._window = self._window, {}
+        rows = []
+        for stage, (count, values) in window.items():
+            s = _percentiles(values)
+            rows.append((window_start, stage, count, s["p50"] * 1000, s["p95"] * 1000,
+                         s["p99"] * 1000, s["max"] * 1000))
+        if rows:
+            conn = db.conn
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO stage_metrics VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def export_chrome_trace(self, path):
+        """Writes the recorded spans in Chrome trace event format. Returns the span count."""
+        with self._lock:
+            events = list(self._events)
+        trace = {"traceEvents": [
+            {
+                "name": stage,
+                "cat": "voice",
+                "ph": "X",
+                "ts": (start_ns - self._origin_ns) / 1000.0,
+                "dur": (end_ns - start_ns) / 1000.0,
+                "pid": os.getpid(),
+                "tid": tid,
+                "args": {"interaction": trace_id},
+            }
+            for stage, start_ns, end_ns, trace_id, tid in events
+        ], "displayTimeUnit": "ms"}
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(trace, f)
+        return len(events)
+
+
+tracer = Tracer()
+
+# --- VOICE ENGINE SETUP ---
+TTS_RATE = 140
+TTS_VOLUME = 1.0
+TTS_CACHE_DIR = "tts_cache"
+TTS_CACHE_MAX_ENTRIES = 200
+TTS_CACHE_MAX_CHARS = 80
+TTS_SEEN_MAX_ENTRIES = 1000   # request counts kept for phrases not cached yet
+
+# Phrases spoken on every wake cycle. These get synthesized to disk while the
+# speech worker is idle so the next "Yes?" starts playing immediately.
+FIXED_PHRASES = [
+    "Yes?",
+    "On it.",
+    "I didn't hear anything.",
+    "I couldn't understand that.",
+    "Opening Youtube",
+    "Opening Google",
+]
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+
+
+class Utterance:
+    """A queued piece of speech. Callers can wait() on it or cancel() it."""
+
+    def __init__(self, text, priority=PRIORITY_NORMAL, trace_id=None):
+        self.text = text
+        self.priority = priority
+        self.trace_id = trace_id
+        self.requested_at = time.perf_counter()
+        self.first_audio_at = None
+        self.done = threading.Event()
+        self._cancel = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def cancel(self):
+        self._cancel.set()
+
+    def wait(self, timeout=None):
+        return self.done.wait(timeout)
+
+    def mark_started(self):
+        if self.first_audio_at is None:
+            self.first_audio_at = time.perf_counter()
+
+    @property
+    def latency(self):
+        """Seconds from say() to the first audio, or None if it never played."""
+        if self.first_audio_at is None:
+            return None
+        return self.first_audio_at - self.requested_at
+
+
+class PhraseCache:
+    """
+    On-disk LRU of synthesized phrases (one WAV per phrase).
+    Fixed phrases are always cached, anything else once it has been asked for twice.
+    """
+
+    def __init__(self, directory=TTS_CACHE_DIR, max_entries=TTS_CACHE_MAX_ENTRIES,
+                 max_seen=TTS_SEEN_MAX_ENTRIES):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_seen = max_seen
+        self._index = OrderedDict()
+        self._seen = OrderedDict()  # text -> requests, least recently asked first
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        # Oldest first, so the LRU order survives restarts
+        files = [f for f in os.listdir(directory) if f.endswith(".wav")]
+        files.sort(key=lambda f: os.path.getmtime(os.path.join(directory, f)))
+        for f in files:
+            self._index[f[:-4]] = os.path.join(directory, f)
+
+    @staticmethod
+    def key(text, voice_id):
+        raw = f"{voice_id}|{TTS_RATE}|{TTS_VOLUME}|{text.strip().lower()}"
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    def path_for(self, key):
+        return os.path.join(self.directory, key + ".wav")
+
+    def note_request(self, text):
+        if len(text) > TTS_CACHE_MAX_CHARS:
+            return  # never cached, so not worth counting
+        phrase = text.strip().lower()
+        with self._lock:
+            self._seen[phrase] = self._seen.pop(phrase, 0) + 1
+            while len(self._seen) > self.max_seen:
+                self._seen.popitem(last=False)
+
+    def should_cache(self, text):
+        if text in FIXED_PHRASES:
+            return True
+        with self._lock:
+            return len(text) <= TTS_CACHE_MAX_CHARS and self._seen.get(text.strip().lower(), 0) >= 2
+
+    def get(self, key):
+        with self._lock:
+            path = self._index.get(key)
+            if path is None:
+                return None
+            if not os.path.exists(path):
+                del self._index[key]
+                return None
+            self._index.move_to_end(key)
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return path
+
+    def put(self, key, path):
+        with self._lock:
+            self._index[key] = path
+            self._index.move_to_end(key)
+            while len(self._index) > self.max_entries:
+                _, old_path = self._index.popitem(last=False)
+                try:
+                    os.remove(old_path)
+                except OSError:
+                    pass
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._index
+
+
+def _wav_duration(path):
+    with wave.open(path, "rb") as wf:
+        return wf.getnframes() / float(wf.getframerate() or 1)
+
+
+class SpeechService:
+    """
+    Long-lived TTS worker. One pyttsx3 engine is created on the worker thread
+    and reused for every utterance (pyttsx3 engines are not thread-safe).
+    Cached phrases are played straight from disk instead of being re-synthesized.
+    """
+
+    def __init__(self, cache=None):
+        self.cache = cache
+        self._queue = queue.PriorityQueue()
+        self._seq = itertools.count()
+        self._current = None
+        self._pending_synth = []
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._ready = threading.Event()
+        self.engine = None
+        self.voice_id = None
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None:
+                if self.cache is None:
+                    self.cache = PhraseCache()
+                self._thread = threading.Thread(target=self._run, name="speech", daemon=True)
+                self._thread.start()
+        return self
+
+    def say(self, text, priority=PRIORITY_NORMAL, trace_id=None):
+        """Queue text for speaking and return its Utterance without blocking."""
+        self.start()
+        utt = Utterance(text, priority, trace_id)
+        self._queue.put((priority, next(self._seq), utt))
+        return utt
+
+    def cancel_all(self):
+        """Drop everything queued and interrupt whatever is playing right now."""
+        while True:
+            try:
+                _, _, utt = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            utt.cancel()
+            utt.done.set()
+        current = self._current
+        if current is not None:
+            current.cancel()
+
+    # --- worker thread ---
+    def _init_engine(self):
+        engine = pyttsx3.init()
+        voices = engine.getProperty('voices')
+        if len(voices) > 1:
+            engine.setProperty('voice', voices[1].id)
+        engine.setProperty('rate', TTS_RATE)
+        engine.setProperty('volume', TTS_VOLUME)
+        engine.connect('started-utterance', self._on_started)
+        engine.connect('started-word', self._on_word)
+        self.voice_id = engine.getProperty('voice')
+        self.engine = engine
+
+    def _on_started(self, name):
+        if self._current is not None:
+            self._current.mark_started()
+
+    def _on_word(self, name, location, length):
+        if self._current is not None and self._current.cancelled:
+            self.engine.stop()
+
+    def _run(self):
+        try:
+            self._init_engine()
+        except Exception as e:
+            print(f"TTS Error: {e}")
+        self._pending_synth = [p for p in FIXED_PHRASES]
+        self._ready.set()
+
+        while True:
+            try:
+                _, _, utt = self._queue.get(timeout=0.25)
+            except queue.Empty:
+                self._synthesize_next()
+                continue
+
+            if utt.cancelled:
+                utt.done.set()
+                continue
+
+            self._current = utt
+            try:
+                self._speak(utt)
+            except Exception as e:
+                print(f"TTS Error: {e}")
+            finally:
+                self._current = None
+                utt.done.set()
+            if utt.latency is not None:
+                tracer.observe("tts.first_audio", utt.latency, utt.trace_id)
+
+    def _speak(self, utt):
+        print(f"DEBUG: Speaking -> {utt.text}")
+        self.cache.note_request(utt.text)
+        key = PhraseCache.key(utt.text, self.voice_id)
+
+        path = self.cache.get(key)
+        if path and _play_wav(path, utt):
+            return
+
+        if self.engine is None:
+            return
+        self.engine.say(utt.text)
+        self.engine.runAndWait()
+
+        if self.cache.should_cache(utt.text) and utt.text not in self._pending_synth:
+            self._pending_synth.append(utt.text)
+
+    def _synthesize_next(self):
+        """Render one pending phrase to disk. Only runs while the queue is idle."""
+        while self._pending_synth and self.engine is not None:
+            text = self._pending_synth.pop(0)
+            key = PhraseCache.key(text, self.voice_id)
+            if key in self.cache:
+                continue
+            path = self.cache.path_for(key)
+            tmp_path = path + ".tmp.wav"
+            try:
+                self.engine.save_to_file(text, tmp_path)
+                self.engine.runAndWait()
+                if os.path.exists(tmp_path) and os.path.getsize(tmp_path) > 0:
+                    os.replace(tmp_path, path)
+                    self.cache.put(key, path)
+            except Exception as e:
+                print(f"TTS Cache Error: {e}")
+            return
+
+
+def _play_wav(path, utt):
+    """
+    Plays a cached WAV file, stopping early if the utterance is cancelled.
+    Returns False when no player is available so the caller falls back to live TTS.
+    """
+    try:
+        duration = _wav_duration(path)
+    except (wave.Error, EOFError, OSError):
+        return False
+
+    if winsound is not None:
+        winsound.PlaySound(path, winsound.SND_FILENAME | winsound.SND_ASYNC)
+        utt.mark_started()
+        if utt._cancel.wait(duration):
+            winsound.PlaySound(None, 0)
+        return True
+
+    player = shutil.which("aplay") or shutil.which("afplay")
+    if not player:
+        return False
+    args = [player, "-q", path] if player.endswith("aplay") else [player, path]
+    proc = subprocess.Popen(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    utt.mark_started()
+    while proc.poll() is None:
+        if utt._cancel.wait(0.05):
+            proc.terminate()
+            break
+    return True
+
+
+speech = SpeechService()
+
+
+# --- WEB SPEECH (SERVER MODE) ---
+# Browser sessions can't use the server's speaker: replies are rendered to WAV
+# on TTS_POOL and sent to the page as audio clips, one after another.
+_web_tts = threading.local()
+_web_phrases = None
+
+
+def synthesize_wav(text):
+    """WAV bytes for text, from the phrase cache when possible. Runs on TTS_POOL."""
+    global _web_phrases
+    if _web_phrases is None:
+        _web_phrases = PhraseCache()
+    engine = getattr(_web_tts, "engine", None)
+    if engine is None:
+        engine = _web_tts.engine = pyttsx3.init()
+        engine.setProperty('rate', TTS_RATE)
+        engine.setProperty('volume', TTS_VOLUME)
+    _web_phrases.note_request(text)
+    key = PhraseCache.key(text, "web")
+    path = _web_phrases.get(key)
+    if path is None:
+        path = _web_phrases.path_for(key) + f".{threading.get_ident()}.tmp.wav"
+        engine.save_to_file(text, path)
+        engine.runAndWait()
+        with open(path, "rb") as f:
+            wav = f.read()
+        if _web_phrases.should_cache(text):
+            os.replace(path, _web_phrases.path_for(key))
+            _web_phrases.put(key, _web_phrases.path_for(key))
+        else:
+            os.remove(path)
+        return wav
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _wav_silence(seconds=0.05, rate=16000):
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as wf:
+        wf.setnchannels(1)
+        wf.setsampwidth(2)
+        wf.setframerate(rate)
+        wf.writeframes(bytes(2 * int(seconds * rate)))
+    return buf.getvalue()
+
+
+def _wav_bytes_duration(wav):
+    try:
+        with wave.open(io.BytesIO(wav), "rb") as wf:
+            return wf.getnframes() / float(wf.getframerate() or 1)
+    except (wave.Error, EOFError):
+        return 0.0
+
+
+class AudioDispatcher:
+    """One thread that hands every web session's clips to its page when the previous one has finished."""
+
+    def __init__(self):
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def schedule(self, speaker, utt, wav):
+        with self._cond:
+            start = max(time.monotonic(), speaker.busy_until)
+            speaker.busy_until = start + _wav_bytes_duration(wav)
+            heapq.heappush(self._heap, (start, next(self._seq), speaker, utt, wav))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="web-audio", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    self._cond.wait(self._heap[0][0] - time.monotonic() if self._heap else None)
+                _, _, speaker, utt, wav = heapq.heappop(self._heap)
+            if utt.cancelled:
+                continue
+            try:
+                speaker.send(wav)
+                utt.mark_started()
+                tracer.observe("tts.first_audio", utt.latency, utt.trace_id)
+            except Exception as e:
+                print(f"Web Audio Error: {e}")
+
+
+web_audio = AudioDispatcher()
+
+
+class WebSpeaker:
+    """
+    Speech for one browser session, with the SpeechService interface. say()
+    returns once the clip is rendered and queued, so command workers are not
+    held while the browser plays it.
+    """
+
+    def __init__(self, page):
+        self.page = page
+        self.busy_until = 0.0
+        self._pending = []
+        self._lock = threading.Lock()
+        # One player per session, on the page from the start; send() only swaps its source
+        self._audio = ft.Audio(src_base64=base64.b64encode(_wav_silence()).decode("ascii"), autoplay=False)
+        page.overlay.append(self._audio)
+
+    def say(self, text, priority=PRIORITY_NORMAL, trace_id=None):
+        utt = Utterance(text, priority, trace_id)
+        with self._lock:
+            self._pending = [u for u in self._pending if not u.done.is_set()] + [utt]
+        # One TTS worker, so clips come back in the order they were asked for
+        future = TTS_POOL.submit(synthesize_wav, text)
+        future.add_done_callback(lambda f: self._rendered(utt, f))
+        return utt
+
+    def _rendered(self, utt, future):
+        try:
+            if not utt.cancelled:
+                web_audio.schedule(self, utt, future.result())
+        except Exception as e:
+            print(f"TTS Error: {e}")
+        finally:
+            utt.done.set()
+
+    def send(self, wav):
+        # The previous clip has finished by now
+        ui = ui_for(self.page)
+        ui.set(self._audio, src_base64=base64.b64encode(wav).decode("ascii"))
+        ui.call(self._audio.play)
+
+    def cancel_all(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for utt in pending:
+            utt.cancel()
+        self.busy_until = 0.0
+
+# --- DATABASE MANAGER ---
+DB_PATH = "user_data.db"
+
+# Everything except the password, in the order User stores it
+USER_COLUMNS = ("id", "email", "first_name", "last_name", "age",
+                "occupation_type", "institution_or_company", "wake_word", "stt_backend")
+_USER_SELECT = "SELECT " + ", ".join(USER_COLUMNS) + " FROM users"
+
+DB_PRAGMAS = (
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -8000",
+    "PRAGMA foreign_keys = ON",
+)
+
+
+class User:
+    """A row of the users table, without the password."""
+    __slots__ = USER_COLUMNS
+
+    def __init__(self, *values):
+        values += (None,) * (len(USER_COLUMNS) - len(values))
+        for name, value in zip(USER_COLUMNS, values):
+            setattr(self, name, value)
+
+    def __repr__(self):
+        return f"User(id={self.id}, email={self.email!r})"
+
+
+class Database:
+    """
+    SQLite in WAL mode with one connection per thread, so the UI thread, the
+    voice pipeline and its executor threads never share a connection.
+    Readers don't block the writer; writers queue up on busy_timeout.
+    Tables are created lazily: each store passes its create callback to
+    connection(), which runs it once per database.
+    """
+
+    def __init__(self, path=DB_PATH):
+        # Nothing touches the disk until the first query (or the warm-up)
+        self.path = path
+        self._local = threading.local()
+        self._schemas = set()
+        self._init_lock = threading.Lock()
+
+    def connection(self, schema=None):
+        """
+        This thread's connection, opened and tuned on first use. schema is
+        an optional callback, schema(conn), that creates a store's tables;
+        it runs the first time it is passed in.
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # sqlite3 keeps compiled statements per connection, keyed by SQL text
+            conn = sqlite3.connect(self.path, timeout=5.0, cached_statements=256)
+            for pragma in DB_PRAGMAS:
+                conn.execute(pragma)
+            self._local.conn = conn
+        self._ensure_schema(conn, self._setup)
+        if schema is not None:
+            self._ensure_schema(conn, schema)
+        return conn
+
+    def _ensure_schema(self, conn, schema):
+        if schema not in self._schemas:
+            with self._init_lock:
+                if schema not in self._schemas:
+                    schema(conn)
+                    self._schemas.add(schema)
+
+    def _setup(self, conn):
+        conn.execute("PRAGMA journal_mode = WAL")
+        self.create_table(conn)
+
+    @property
+    def conn(self):
+        return self.connection()
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def create_table(self, conn):
+        cursor = conn.cursor()
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                email TEXT UNIQUE,
+                password TEXT,
+                first_name TEXT,
+                last_name TEXT,
+                age INTEGER,
+                occupation_type TEXT,
+                institution_or_company TEXT,
+                wake_word TEXT DEFAULT 'hey alexa'
+            )
+        """)
+        # Columns added after the first release
+        columns = {row[1] for row in cursor.execute("PRAGMA table_info(users)")}
+        if "stt_backend" not in columns:
+            cursor.execute("ALTER TABLE users ADD COLUMN stt_backend TEXT")
+        conn.commit()
+
+    def register_user(self, email, password, fname, lname, age, occ_type, place):
+        conn = self.conn
+        try:
+            with conn:
+                conn.execute("""
+                    INSERT INTO users (email, password, first_name, last_name, age, occupation_type, institution_or_company)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                """, (email, password, fname, lname, age, occ_type, place))
+            return True
+        except sqlite3.IntegrityError:
+            return False
+
+    def register_users(self, rows):
+        """
+        Batched insert of (email, password, fname, lname, age, occ_type, place)
+        tuples in one transaction. Existing emails are skipped. Returns the number added.
+        """
+        conn = self.conn
+        with conn:
+            before = conn.total_changes
+            conn.executemany("""
+                INSERT OR IGNORE INTO users (email, password, first_name, last_name, age, occupation_type, institution_or_company)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, rows)
+            return conn.total_changes - before
+
+    def import_users(self, path):
+        """Bulk user import from CSV (with a header row) or a JSON list of objects."""
+        fields = ("email", "password", "first_name", "last_name", "age",
+                  "occupation_type", "institution_or_company")
+        with open(path, newline="", encoding="utf-8") as f:
+            records = json.load(f) if path.lower().endswith(".json") else list(csv.DictReader(f))
+        rows = [tuple(r.get(name) for name in fields) for r in records if r.get("email")]
+        return self.register_users(rows)
+
+    def login_user(self, email, password):
+        row = self.conn.execute(_USER_SELECT + " WHERE email = ? AND password = ?", (email, password)).fetchone()
+        return User(*row) if row else None
+
+    def get_user(self, user_id):
+        row = self.conn.execute(_USER_SELECT + " WHERE id = ?", (user_id,)).fetchone()
+        return User(*row) if row else None
+
+    def update_wake_word(self, user_id, new_word):
+        conn = self.conn
+        with conn:
+            conn.execute("UPDATE users SET wake_word = ? WHERE id = ?", (new_word, user_id))
+
+    def update_stt_backend(self, user_id, backend):
+        conn = self.conn
+        with conn:
+            conn.execute("UPDATE users SET stt_backend = ? WHERE id = ?", (backend, user_id))
+
+db = Database()
+
+# --- SESSION STATE ---
+class AppState:
+    """
+    Everything one user of the app has going on. The desktop app has exactly
+    one (state); server mode creates one per browser session.
+    """
+
+    def __init__(self, web=False):
+        self.current_user = None
+        self.is_listening = False
+        self.wake_word = "hey alexa"
+        self.perf_panel_gen = 0
+        self.pipeline = None
+        self.web = web
+        self.speaker = None   # WebSpeaker in server mode, else the shared SpeechService
+        self.active = None    # (future, cancel) of the typed command in flight
+        self.actions = None   # ActionExecutor for side effects; None means the shared one
+        self.page = None      # the browser tab of a web session
+
+state = AppState()
+
+# --- SHARED WORKER POOLS ---
+# Heavy work from every session funnels into a few bounded pools instead of
+# per-session threads. A full pool rejects new work with Overloaded right
+# away (back-pressure) rather than letting latency grow without bound.
+SERVER_MODE = False
+MAX_SESSIONS = int(os.getenv("NEON_MAX_SESSIONS", "50"))
+POOL_SIZES = {  # name: (workers, queued jobs on top)
+    "command": (8, 32),
+    "stt": (2, 8),
+    "llm": (4, 16),
+    "tts": (1, 16),   # pyttsx3 only allows one engine per process
+    "action": (2, 16),
+}
+
+
+class Overloaded(Exception):
+    """A shared pool or the session limit is full; try again later."""
+
+
+class WorkerPool:
+    """A ThreadPoolExecutor with a cap on queued work."""
+
+    def __init__(self, name, workers, queue_size):
+        self.name = name
+        self.workers = workers
+        self._executor = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix=name)
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+
+    def submit(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise Overloaded(f"{self.name} pool is full")
+        with self._lock:
+            self.in_flight += 1
+        future = self._executor.submit(fn, *args)
+        future.add_done_callback(self._finished)
+        return future
+
+    def _finished(self, future):
+        with self._lock:
+            self.in_flight -= 1
+            self.completed += 1
+        self._slots.release()
+
+    def run(self, fn, *args):
+        """submit() and wait for the result."""
+        return self.submit(fn, *args).result()
+
+    def stream(self, fn, *args):
+        """
+        Starts generator function fn on the pool right away and returns an
+        iterator over its items as they are produced. Raises Overloaded.
+        """
+        items = queue.Queue()
+        finished = object()
+
+        def produce():
+            try:
+                for item in fn(*args):
+                    items.put((item, None))
+            except Exception as e:
+                items.put((finished, e))
+                return
+            items.put((finished, None))
+
+        def results():
+            while True:
+                item, error = items.get()
+                if item is finished:
+                    if error is not None:
+                        raise error
+                    return
+                yield item
+
+        self.submit(produce)
+        return results()
+
+    def stats(self):
+        with self._lock:
+            return {"workers": self.workers, "in_flight": self.in_flight,
+                    "completed": self.completed, "rejected": self.rejected}
+
+
+def _pool(name):
+    workers, queue_size = POOL_SIZES[name]
+    workers = int(os.getenv(f"NEON_{name.upper()}_WORKERS", workers))
+    return WorkerPool(name, workers, queue_size)
+
+
+COMMAND_POOL = _pool("command")
+STT_POOL = _pool("stt")
+LLM_POOL = _pool("llm")
+TTS_POOL = _pool("tts")
+ACTION_POOL = _pool("action")
+POOLS = (COMMAND_POOL, STT_POOL, LLM_POOL, TTS_POOL, ACTION_POOL)
+
+
+class SessionManager:
+    """Admission control for server mode: at most limit sessions at once."""
+
+    def __init__(self, limit=MAX_SESSIONS):
+        self.limit = limit
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self.rejected = 0
+
+    def open(self, key):
+        with self._lock:
+            if len(self._sessions) >= self.limit:
+                self.rejected += 1
+                raise Overloaded(f"{self.limit} sessions already open")
+            session = self._sessions[key] = AppState(web=True)
+            return session
+
+    def close(self, key):
+        """Releases everything the session holds: its command, speech, UI flusher and panel thread."""
+        with self._lock:
+            session = self._sessions.pop(key, None)
+        if session is None:
+            return
+        cancel_command(session)
+        session.perf_panel_gen += 1  # ends the dashboard's perf_loop
+        if session.speaker is not None:
+            session.speaker.cancel_all()
+        if session.page is not None:
+            drop_ui(session.page)
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+sessions = SessionManager()
+
+# --- ACTION EXECUTOR ---
+# Side effects of a command (opening a page, starting an app) are handed to
+# ACTION_POOL and the command carries on; the outcome comes back through a
+# callback instead of the command sleeping until it has probably happened.
+APP_LAUNCH_GRACE = 1.0  # an app that dies within this long failed to start
+
+ACTIONS = {}
+
+
+def action(kind):
+    """Decorator: registers fn(payload) as the handler for actions of kind."""
+    def register(fn):
+        ACTIONS[kind] = fn
+        return fn
+    return register
+
+
+@action("open_url")
+def open_url_action(url):
+    if not webbrowser.open(url):
+        raise OSError(f"no browser could open {url}")
+    return url
+
+
+@action("launch_app")
+def launch_app_action(command):
+    """Starts command and returns the process once it is clearly up (or already done fine)."""
+    proc = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        code = proc.wait(timeout=APP_LAUNCH_GRACE)
+    except subprocess.TimeoutExpired:
+        return proc
+    if code:
+        raise OSError(f"{command} exited with code {code}")
+    return proc
+
+
+class ActionExecutor:
+    """Runs registered actions on ACTION_POOL, timing each as action.<kind>."""
+
+    def __init__(self, pool=ACTION_POOL):
+        self.pool = pool
+
+    def run(self, kind, payload, on_done=None, trace_id=None):
+        """
+        Starts action kind with payload and returns its future right away.
+        on_done(future) is called when it has finished or failed. Raises
+        KeyError for an unknown kind and Overloaded when the pool is full.
+        """
+        handler = ACTIONS[kind]
+        start_ns = time.perf_counter_ns()
+
+        def finished(future):
+            tracer.record(f"action.{kind}", start_ns, time.perf_counter_ns(), trace_id)
+            if future.exception() is not None:
+                print(f"Action Error ({kind}): {future.exception()}")
+            if on_done is not None:
+                on_done(future)
+
+        future = self.pool.submit(handler, payload)
+        future.add_done_callback(finished)
+        return future
+
+
+actions = ActionExecutor()
+
+# --- INTENT ROUTER ---
+SITES = {
+    "youtube": "https://www.youtube.com",
+    "google": "https://www.google.com",
+    "facebook": "https://www.facebook.com",
+    "instagram": "https://www.instagram.com",
+    "linkedin": "https://www.linkedin.com"
+}
+
+SYSTEM_APPS = {
+    "calculator": "calc.exe",
+    "notepad": "notepad.exe",
+}
+
+# Higher wins. Same order the old if-chain checked things in.
+INTENT_PRIORITY = {"site": 40, "time": 30, "date": 30, "app": 20}
+
+_TOKEN_RE = re.compile(r"[a-z0-9']+")
+_END = None  # trie key holding the intents that end at a node
+
+
+def tokenize(text):
+    return _TOKEN_RE.findall(text.lower())
+
+
+class Intent:
+    """One routable phrase. requires lists words of which at least one must also appear."""
+    __slots__ = ("kind", "key", "payload", "priority", "tokens", "requires", "alone_ok")
+
+    def __init__(self, kind, key, payload=None, requires=(), alone_ok=False):
+        self.kind = kind
+        self.key = key
+        self.payload = payload
+        self.priority = INTENT_PRIORITY[kind]
+        self.tokens = tuple(tokenize(key))
+        self.requires = tuple(requires)
+        self.alone_ok = alone_ok
+
+    def accepts(self, command):
+        if not self.requires:
+            return True
+        if self.alone_ok and command.strip() == self.key:
+            return True
+        return any(word in command for word in self.requires)
+
+
+class RouteMatch:
+    __slots__ = ("intent", "start", "end")
+
+    def __init__(self, intent, start, end):
+        self.intent = intent
+        self.start = start
+        self.end = end
+
+    @property
+    def kind(self):
+        return self.intent.kind
+
+
+class IntentRouter:
+    """
+    Word-level trie over every routable phrase (sites, apps, time/date).
+    Routing walks the trie from each token of the command, so the cost depends
+    on the command length and the longest phrase, not on how many phrases exist.
+    Highest priority wins, then the longest phrase, then the earliest one.
+    Songs are not in here; the MusicCatalog looks them up.
+    """
+
+    def __init__(self):
+        self._root = {}
+        self._by_key = {}
+        self.max_len = 0
+
+    def __len__(self):
+        return len(self._by_key)
+
+    def add(self, intent):
+        if not intent.tokens:
+            return
+        self.remove(intent.kind, intent.key)
+        node = self._root
+        for tok in intent.tokens:
+            node = node.setdefault(tok, {})
+        node.setdefault(_END, []).append(intent)
+        self._by_key[(intent.kind, intent.key)] = intent
+        self.max_len = max(self.max_len, len(intent.tokens))
+
+    def remove(self, kind, key):
+        intent = self._by_key.pop((kind, key), None)
+        if intent is None:
+            return
+        path = [self._root]
+        for tok in intent.tokens:
+            path.append(path[-1][tok])
+        ends = path[-1][_END]
+        ends.remove(intent)
+        if not ends:
+            del path[-1][_END]
+        # Prune nodes that no longer lead anywhere
+        for depth in range(len(intent.tokens), 0, -1):
+            if path[depth]:
+                break
+            del path[depth - 1][intent.tokens[depth - 1]]
+
+    def keys(self, kind):
+        return [key for k, key in self._by_key if k == kind]
+
+    def sync(self, kind, entries, **intent_kwargs):
+        """Incrementally brings one kind in line with {key: payload}."""
+        for key in self.keys(kind):
+            if key not in entries:
+                self.remove(kind, key)
+        for key, payload in entries.items():
+            current = self._by_key.get((kind, key))
+            if current is None or current.payload != payload:
+                self.add(Intent(kind, key, payload, **intent_kwargs))
+
+    def route(self, command):
+        command = command.lower()
+        tokens = tokenize(command)
+        best, best_rank = None, None
+        for i in range(len(tokens)):
+            node = self._root
+            for j in range(i, min(len(tokens), i + self.max_len)):
+                node = node.get(tokens[j])
+                if node is None:
+                    break
+                for intent in node.get(_END, ()):
+                    rank = (intent.priority, j - i + 1, -i)
+                    if (best_rank is None or rank > best_rank) and intent.accepts(command):
+                        best, best_rank = RouteMatch(intent, i, j + 1), rank
+        return best
+
+
+def build_router():
+    router = IntentRouter()
+    router.sync("site", SITES, requires=("open", "launch"), alone_ok=True)
+    router.add(Intent("time", "time", requires=("what",)))
+    router.add(Intent("date", "date", requires=("what",)))
+    router.sync("app", {f"open {name}": exe for name, exe in SYSTEM_APPS.items()})
+    return router
+
+
+router = build_router()
+
+
+def register_app(name, command):
+    """Makes "open <name>" launch command (anything subprocess.Popen accepts)."""
+    SYSTEM_APPS[name] = command
+    router.add(Intent("app", f"open {name}", command))
+
+# --- MUSIC CATALOG ---
+# musicLibrary.py is still the place to add a handful of songs. It is only
+# imported when it changed since the last sync; lookups go to SQLite.
+MUSIC_LIBRARY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "musicLibrary.py")
+MUSIC_LIBRARY_SOURCE = "musicLibrary"
+CATALOG_MAX_PHRASE_WORDS = 8
+CATALOG_FUZZY_MIN_SCORE = 0.75
+
+_SOUNDEX_CODES = {c: str(d) for d, letters in enumerate(
+    ["aehiouwy", "bfpv", "cgjkqsxz", "dt", "l", "mn", "r"]) for c in letters}
+
+
+def soundex(word):
+    """Classic 4-character Soundex code, used for sound-alike transcript matches."""
+    word = "".join(c for c in word.lower() if c.isalpha())
+    if not word:
+        return ""
+    code = word[0].upper()
+    last = _SOUNDEX_CODES.get(word[0], "")
+    for c in word[1:]:
+        digit = _SOUNDEX_CODES.get(c, "")
+        if digit and digit != "0" and digit != last:
+            code += digit
+        if c not in "hw":
+            last = digit
+    return (code + "000")[:4]
+
+
+def normalize_title(title):
+    return " ".join(tokenize(title))
+
+
+def phonetic_key(title):
+    return " ".join(soundex(w) for w in tokenize(title))
+
+
+def _fts_quote(term):
+    return '"' + term.replace('"', '""') + '"'
+
+
+class MusicCatalog:
+    """
+    Song catalog stored in user_data.db. Titles are looked up on demand:
+    exact n-grams of the command through the unique title index, then FTS5
+    prefix search, trigram typo matching and Soundex keys for "play X".
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.has_fts = False
+        self.has_trigram = False
+
+    @property
+    def conn(self):
+        return self.db.connection(self.create_tables)
+
+    def create_tables(self, conn):
+        cursor = conn.cursor()
+        cursor.executescript("""
+            CREATE TABLE IF NOT EXISTS songs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                title TEXT UNIQUE,
+                url TEXT,
+                phonetic TEXT,
+                source TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_songs_phonetic ON songs(phonetic);
+            CREATE TABLE IF NOT EXISTS catalog_meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+        """)
+        # Columns added after the first release
+        columns = {row[1] for row in cursor.execute("PRAGMA table_info(songs)")}
+        if "source" not in columns:
+            cursor.execute("ALTER TABLE songs ADD COLUMN source TEXT")
+            # Existing rows don't know where they came from; the next sync tags them
+            cursor.execute("DELETE FROM catalog_meta WHERE key = 'music_library_mtime'")
+        try:
+            cursor.executescript("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS songs_fts USING fts5(
+                    title, content='songs', content_rowid='id', prefix='2 3'
+                );
+                CREATE TRIGGER IF NOT EXISTS songs_fts_ai AFTER INSERT ON songs BEGIN
+                    INSERT INTO songs_fts(rowid, title) VALUES (new.id, new.title);
+                END;
+                CREATE TRIGGER IF NOT EXISTS songs_fts_ad AFTER DELETE ON songs BEGIN
+                    INSERT INTO songs_fts(songs_fts, rowid, title) VALUES ('delete', old.id, old.title);
+                END;
+                CREATE TRIGGER IF NOT EXISTS songs_fts_au AFTER UPDATE ON songs BEGIN
+                    INSERT INTO songs_fts(songs_fts, rowid, title) VALUES ('delete', old.id, old.title);
+                    INSERT INTO songs_fts(rowid, title) VALUES (new.id, new.title);
+                END;
+            """)
+            self.has_fts = True
+        except sqlite3.OperationalError as e:
+            print(f"WARNING: FTS5 not available, using plain lookups ({e})")
+        if self.has_fts:
+            try:
+                cursor.executescript("""
+                    CREATE VIRTUAL TABLE IF NOT EXISTS songs_trigram USING fts5(
+                        title, content='songs', content_rowid='id', tokenize='trigram'
+                    );
+                    CREATE TRIGGER IF NOT EXISTS songs_tri_ai AFTER INSERT ON songs BEGIN
+                        INSERT INTO songs_trigram(rowid, title) VALUES (new.id, new.title);
+                    END;
+                    CREATE TRIGGER IF NOT EXISTS songs_tri_ad AFTER DELETE ON songs BEGIN
+                        INSERT INTO songs_trigram(songs_trigram, rowid, title) VALUES ('delete', old.id, old.title);
+                    END;
+                    CREATE TRIGGER IF NOT EXISTS songs_tri_au AFTER UPDATE ON songs BEGIN
+                        INSERT INTO songs_trigram(songs_trigram, rowid, title) VALUES ('delete', old.id, old.title);
+                        INSERT INTO songs_trigram(rowid, title) VALUES (new.id, new.title);
+                    END;
+                """)
+                self.has_trigram = True
+            except sqlite3.OperationalError:
+                pass
+        conn.commit()
+
+    # --- import ---
+    def add_songs(self, entries, source=None):
+        """
+        Bulk upsert of (title, url) pairs in one transaction. Returns the count.
+        source tags where they came from (MUSIC_LIBRARY_SOURCE for musicLibrary.py).
+        """
+        rows = []
+        for title, url in entries:
+            norm = normalize_title(title)
+            if norm and url:
+                rows.append((norm, url, phonetic_key(norm), source))
+        self.conn.executemany("""
+            INSERT INTO songs (title, url, phonetic, source) VALUES (?, ?, ?, ?)
+            ON CONFLICT(title) DO UPDATE SET url = excluded.url, source = excluded.source
+            WHERE songs.url != excluded.url OR songs.source IS NOT excluded.source
+        """, rows)
+        self.conn.commit()
+        return len(rows)
+
+    def remove_song(self, title):
+        self.conn.execute("DELETE FROM songs WHERE title = ?", (normalize_title(title),))
+        self.conn.commit()
+
+    def import_csv(self, path):
+        """CSV with title,url columns (a header row is optional)."""
+        with open(path, newline="", encoding="utf-8") as f:
+            rows = [r for r in csv.reader(f) if len(r) >= 2]
+        if rows and rows[0][0].strip().lower() == "title":
+            rows = rows[1:]
+        return self.add_songs((r[0], r[1].strip()) for r in rows)
+
+    def import_json(self, path):
+        """Either {"title": "url", ...} or [{"title": ..., "url": ...}, ...]."""
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        if isinstance(data, dict):
+            return self.add_songs(data.items())
+        return self.add_songs((d["title"], d["url"]) for d in data)
+
+    def import_file(self, path):
+        if path.lower().endswith(".json"):
+            return self.import_json(path)
+        return self.import_csv(path)
+
+    def sync_music_library(self, path=MUSIC_LIBRARY_FILE, force=False):
+        """
+        Imports musicLibrary.py, but only if the file changed since last time.
+        Songs it no longer lists are removed; imported ones are left alone.
+        """
+        try:
+            stamp = str(os.path.getmtime(path))
+        except OSError:
+            print("WARNING: musicLibrary.py not found.")
+            return 0
+        row = self.conn.execute("SELECT value FROM catalog_meta WHERE key = 'music_library_mtime'").fetchone()
+        if row and row[0] == stamp and not force:
+            return 0
+
+        try:
+            import musicLibrary
+            entries = importlib.reload(musicLibrary).music
+        except ImportError:
+            print("WARNING: musicLibrary.py not found.")
+            return 0
+        count = self.add_songs(entries.items(), source=MUSIC_LIBRARY_SOURCE)
+        listed = {normalize_title(title) for title in entries}
+        stale = [(title,) for (title,) in self.conn.execute(
+            "SELECT title FROM songs WHERE source = ?", (MUSIC_LIBRARY_SOURCE,)) if title not in listed]
+        self.conn.executemany("DELETE FROM songs WHERE title = ?", stale)
+        self.conn.execute(
+            "INSERT OR REPLACE INTO catalog_meta (key, value) VALUES ('music_library_mtime', ?)", (stamp,))
+        self.conn.commit()
+        return count
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM songs").fetchone()[0]
+
+    # --- lookup ---
+    def get(self, title):
+        row = self.conn.execute("SELECT url FROM songs WHERE title = ?", (normalize_title(title),)).fetchone()
+        return row[0] if row else None
+
+    def find_in_text(self, text):
+        """
+        Longest library title that appears word-for-word in text, as (title, url).
+        Checks every n-gram of the text against the unique title index.
+        """
+        tokens = tokenize(text)
+        grams = {}
+        for i in range(len(tokens)):
+            for j in range(i + 1, min(len(tokens), i + CATALOG_MAX_PHRASE_WORDS) + 1):
+                grams.setdefault(" ".join(tokens[i:j]), (j - i, -i))
+        if not grams:
+            return None
+        keys = list(grams)
+        rows = []
+        for k in range(0, len(keys), 500):
+            chunk = keys[k:k + 500]
+            marks = ",".join("?" * len(chunk))
+            rows += self.conn.execute(f"SELECT title, url FROM songs WHERE title IN ({marks})", chunk).fetchall()
+        if not rows:
+            return None
+        return max(rows, key=lambda r: grams[r[0]])
+
+    def search(self, query, limit=5):
+        """
+        Fuzzy lookup for a spoken title. Returns [(score, title, url)] best first,
+        only keeping candidates scoring at least CATALOG_FUZZY_MIN_SCORE.
+        """
+        norm = normalize_title(query)
+        if not norm:
+            return []
+        candidates = {}
+
+        url = self.get(norm)
+        if url:
+            return [(1.0, norm, url)]
+
+        tokens = norm.split()
+        if self.has_fts:
+            prefix_query = " ".join(_fts_quote(t) for t in tokens[:-1]) + " " + _fts_quote(tokens[-1]) + "*"
+            for title, url in self.conn.execute(
+                    "SELECT s.title, s.url FROM songs_fts f JOIN songs s ON s.id = f.rowid "
+                    "WHERE songs_fts MATCH ? LIMIT 50", (prefix_query.strip(),)):
+                candidates[title] = url
+        else:
+            for title, url in self.conn.execute(
+                    "SELECT title, url FROM songs WHERE title LIKE ? LIMIT 50", (norm + "%",)):
+                candidates[title] = url
+
+        if self.has_trigram and len(norm) >= 6:
+            # A single mis-heard letter lands in one half of the title, so
+            # the other half still matches as an exact substring.
+            mid = len(norm) // 2
+            tri_query = _fts_quote(norm[:mid]) + " OR " + _fts_quote(norm[mid:])
+            for title, url in self.conn.execute(
+                    "SELECT s.title, s.url FROM songs_trigram t JOIN songs s ON s.id = t.rowid "
+                    "WHERE songs_trigram MATCH ? LIMIT 100", (tri_query,)):
+                candidates[title] = url
+
+        for title, url in self.conn.execute(
+                "SELECT title, url FROM songs WHERE phonetic = ? LIMIT 50", (phonetic_key(norm),)):
+            candidates[title] = url
+
+        phon = phonetic_key(norm)
+        scored = []
+        for title, url in candidates.items():
+            score = difflib.SequenceMatcher(None, norm, title).ratio()
+            if phonetic_key(title) == phon:
+                score = max(score, 0.9)
+            elif title.startswith(norm) and len(norm) * 2 >= len(title):
+                score = max(score, 0.8)
+            if score >= CATALOG_FUZZY_MIN_SCORE:
+                scored.append((score, title, url))
+        scored.sort(reverse=True)
+        return scored[:limit]
+
+
+catalog = MusicCatalog(db)   # synced by warm_up(), off the startup path
+
+# --- AI MODEL (ONE PER SESSION) ---
+GEMINI_MODEL = "gemini-2.5-flash"
+
+SYSTEM_ROLE = (
+    "You are a helpful, friendly, and concise AI assistant. "
+    "You are speaking to the user through voice. Keep your responses brief and conversational. "
+    "Do NOT use asterisks, markdown formatting, or special characters in your response. "
+    "Speak naturally as if having a voice conversation."
+)
+
+LLM_PREWARM_INTERVAL = 60.0  # idle connections may be closed after about this long
+
+_llm_model = None
+_llm_lock = threading.Lock()
+_llm_used_at = 0.0
+
+
+def get_llm_model():
+    """The Gemini model is built once and reused, so its HTTP client stays warm."""
+    global _llm_model
+    with _llm_lock:
+        if _llm_model is None:
+            configure_genai()
+            _llm_model = genai.GenerativeModel(GEMINI_MODEL, system_instruction=SYSTEM_ROLE)
+        return _llm_model
+
+
+def prewarm_llm():
+    """
+    Builds the model and opens its connection on LLM_POOL, so the question
+    that follows doesn't pay for the handshake. Counting tokens is free.
+    Does nothing if Gemini was used within LLM_PREWARM_INTERVAL.
+    """
+    global _llm_used_at
+    if not API_KEY or time.monotonic() - _llm_used_at < LLM_PREWARM_INTERVAL:
+        return
+    _llm_used_at = time.monotonic()
+    try:
+        LLM_POOL.submit(_prewarm_llm)
+    except Overloaded:
+        _llm_used_at = 0.0
+
+
+def _prewarm_llm():
+    try:
+        with tracer.stage("llm.prewarm"):
+            get_llm_model().count_tokens("hello")
+    except Exception as e:
+        print(f"DEBUG: Gemini pre-warm failed: {e}")
+
+
+_MARKDOWN_RE = re.compile(r"[*#`_~]|^\s*[-+>]\s+|\[(.*?)\]\(.*?\)", re.M)
+_SENTENCE_RE = re.compile(r"(.+?(?:[.!?]+[\"')\]]*(?=\s)|\n))", re.S)
+MIN_SENTENCE_CHARS = 12
+
+
+def clean_markdown(text):
+    """Strips markdown so TTS doesn't read out asterisks and hashes."""
+    text = _MARKDOWN_RE.sub(lambda m: m.group(1) or "", text)
+    return " ".join(text.split())
+
+
+class SentenceSplitter:
+    """
+    Buffers streamed text and hands back complete, markdown-free sentences as
+    soon as they end. Very short pieces ("Sure.") are joined to the next one.
+    """
+
+    def __init__(self, min_chars=MIN_SENTENCE_CHARS):
+        self.min_chars = min_chars
+        self._buf = ""
+        self._carry = ""
+
+    def feed(self, text):
+        self._buf += text
+        out = []
+        while True:
+            m = _SENTENCE_RE.match(self._buf)
+            if not m:
+                break
+            self._buf = self._buf[m.end():]
+            sentence = (self._carry + " " + clean_markdown(m.group(1))).strip()
+            if len(sentence) < self.min_chars:
+                self._carry = sentence
+                continue
+            self._carry = ""
+            out.append(sentence)
+        return out
+
+    def flush(self):
+        sentence = (self._carry + " " + clean_markdown(self._buf)).strip()
+        self._buf = self._carry = ""
+        return [sentence] if sentence else []
+
+
+def stream_reply(command, cancel=None, history=None):
+    """
+    Yields the reply to command one sentence at a time while it is still
+    generating. history is earlier conversation in Gemini's contents format.
+    """
+    global _llm_used_at
+    _llm_used_at = time.monotonic()
+    contents = history + [{"role": "user", "parts": [command]}] if history else command
+    response = get_llm_model().generate_content(contents, stream=True)
+    splitter = SentenceSplitter()
+    for chunk in response:
+        if cancel is not None and cancel.is_set():
+            return
+        try:
+            text = chunk.text
+        except ValueError:
+            # Chunks without text parts (e.g. safety metadata only)
+            continue
+        for sentence in splitter.feed(text):
+            yield sentence
+    for sentence in splitter.flush():
+        yield sentence
+
+# --- AI RESPONSE CACHE ---
+LLM_CACHE_MAX_ENTRIES = 500
+LLM_CACHE_TTL = 7 * 24 * 3600
+LLM_CACHE_VOLATILE_TTL = 15 * 60
+# Set LLM_CACHE_SIMILARITY (e.g. 0.92) to also reuse answers to reworded questions
+LLM_CACHE_SIMILARITY = float(os.getenv("LLM_CACHE_SIMILARITY", "0") or 0)
+EMBEDDING_MODEL = "models/text-embedding-004"
+
+FILLER_WORDS = {
+    "um", "uh", "erm", "hmm", "ah", "oh", "please", "hey", "ok", "okay", "so", "well",
+    "just", "actually", "basically", "kindly", "a", "an", "the",
+}
+FILLER_PREFIXES = [
+    "can you", "could you", "would you", "will you", "tell me", "i want to know",
+    "do you know", "i wonder",
+]
+CONTRACTIONS = {"what's": "what is", "who's": "who is", "where's": "where is", "how's": "how is",
+                "it's": "it is", "that's": "that is", "what're": "what are"}
+# Answers to these go stale quickly
+VOLATILE_WORDS = {
+    "weather", "news", "today", "tonight", "tomorrow", "now", "current", "currently",
+    "latest", "score", "price", "stock", "time", "date", "yesterday",
+}
+
+
+def normalize_query(text):
+    """Cache key for a spoken question: lowercase, no punctuation or filler words."""
+    words = []
+    for tok in tokenize(text):
+        words.extend(CONTRACTIONS.get(tok, tok).split())
+    phrase = " ".join(w for w in words if w not in FILLER_WORDS)
+    changed = True
+    while changed:
+        changed = False
+        for prefix in FILLER_PREFIXES:
+            if phrase.startswith(prefix + " "):
+                phrase = phrase[len(prefix) + 1:]
+                changed = True
+    return " ".join(w for w in phrase.split() if w not in FILLER_WORDS)
+
+
+def cache_key(text, context=None):
+    """
+    normalize_query(text), scoped to context (the question before it in the
+    conversation) when there is one. "why is that?" then means the same thing
+    every time its key comes up.
+    """
+    key = normalize_query(text)
+    if key and context:
+        key = f"{normalize_query(context)} | {key}"
+    return key
+
+
+def cache_ttl(key):
+    return LLM_CACHE_VOLATILE_TTL if VOLATILE_WORDS & set(key.split()) else LLM_CACHE_TTL
+
+
+def _cosine(a, b):
+    dot = sum(x * y for x, y in zip(a, b))
+    na = math.sqrt(sum(x * x for x in a))
+    nb = math.sqrt(sum(y * y for y in b))
+    return dot / (na * nb) if na and nb else 0.0
+
+
+class ResponseCache:
+    """
+    Gemini replies cached per user in user_data.db, keyed on the normalized
+    question (see cache_key). Entries expire after their TTL and the least
+    recently used ones are evicted once there are more than max_entries.
+    Similar-question matching only applies to questions asked without context.
+    """
+
+    def __init__(self, db, max_entries=LLM_CACHE_MAX_ENTRIES, similarity=LLM_CACHE_SIMILARITY):
+        self.db = db
+        self.max_entries = max_entries
+        self.similarity = similarity
+        self.hits = 0
+        self.misses = 0
+        self.hit_seconds = 0.0
+        self.miss_seconds = 0.0
+
+    @property
+    def conn(self):
+        return self.db.connection(self.create_table)
+
+    def create_table(self, conn):
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS llm_cache (
+                user_id INTEGER,
+                query_key TEXT,
+                reply TEXT,
+                created_at REAL,
+                expires_at REAL,
+                last_used REAL,
+                hits INTEGER DEFAULT 0,
+                embedding BLOB,
+                PRIMARY KEY (user_id, query_key)
+            );
+            CREATE INDEX IF NOT EXISTS idx_llm_cache_last_used ON llm_cache(last_used);
+        """)
+        conn.commit()
+
+    def _embed(self, key):
+        configure_genai()
+        result = genai.embed_content(model=EMBEDDING_MODEL, content=key)
+        return array("f", result["embedding"])
+
+    def get(self, user_id, text, context=None):
+        """Returns the cached reply or None. Counts a hit or a miss."""
+        key = cache_key(text, context)
+        if not key:
+            return None
+        now = time.time()
+        row = self.conn.execute(
+            "SELECT reply, expires_at FROM llm_cache WHERE user_id = ? AND query_key = ?",
+            (user_id, key)).fetchone()
+        if row and row[1] < now:
+            self.conn.execute("DELETE FROM llm_cache WHERE user_id = ? AND query_key = ?", (user_id, key))
+            self.conn.commit()
+            row = None
+
+        if row is None and self.similarity > 0 and not context:
+            row = self._similar(user_id, key, now)
+            if row is not None:
+                key = row[1]
+
+        if row is None:
+            return None
+        self.conn.execute(
+            "UPDATE llm_cache SET last_used = ?, hits = hits + 1 WHERE user_id = ? AND query_key = ?",
+            (now, user_id, key))
+        self.conn.commit()
+        return row[0]
+
+    def peek(self, user_id, text, context=None):
+        """
+        Whether an unexpired answer for exactly this question is stored.
+        Read-only: no hit counting, no LRU bump, no embedding request.
+        """
+        key = cache_key(text, context)
+        return bool(key) and self.conn.execute(
+            "SELECT 1 FROM llm_cache WHERE user_id = ? AND query_key = ? AND expires_at >= ?",
+            (user_id, key, time.time())).fetchone() is not None
+
+    def _similar(self, user_id, key, now):
+        try:
+            vec = self._embed(key)
+        except Exception as e:
+            print(f"Cache Embedding Error: {e}")
+            return None
+        rows = self.conn.execute(
+            "SELECT reply, query_key, embedding FROM llm_cache "
+            "WHERE user_id = ? AND expires_at >= ? AND embedding IS NOT NULL AND instr(query_key, '|') = 0",
+            (user_id, now)).fetchall()
+        best, best_score = None, self.similarity
+        for reply, query_key, blob in rows:
+            score = _cosine(vec, array("f", blob))
+            if score >= best_score:
+                best, best_score = (reply, query_key), score
+        return best
+
+    def put(self, user_id, text, reply, context=None):
+        key = cache_key(text, context)
+        if not key or not reply:
+            return
+        blob = None
+        if self.similarity > 0 and not context:
+            try:
+                blob = self._embed(key).tobytes()
+            except Exception as e:
+                print(f"Cache Embedding Error: {e}")
+        now = time.time()
+        self.conn.execute("""
+            INSERT OR REPLACE INTO llm_cache
+                (user_id, query_key, reply, created_at, expires_at, last_used, hits, embedding)
+            VALUES (?, ?, ?, ?, ?, ?, 0, ?)
+        """, (user_id, key, reply, now, now + cache_ttl(key), now, blob))
+        self.conn.execute("DELETE FROM llm_cache WHERE expires_at < ?", (now,))
+        overflow = self.conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0] - self.max_entries
+        if overflow > 0:
+            self.conn.execute("""
+                DELETE FROM llm_cache WHERE rowid IN (
+                    SELECT rowid FROM llm_cache ORDER BY last_used LIMIT ?
+                )
+            """, (overflow,))
+        self.conn.commit()
+
+    def record(self, hit, seconds):
+        if hit:
+            self.hits += 1
+            self.hit_seconds += seconds
+        else:
+            self.misses += 1
+            self.miss_seconds += seconds
+
+    def stats(self):
+        entries = self.conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+        total = self.hits + self.misses
+        return {
+            "entries": entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "avg_hit_ms": 1000 * self.hit_seconds / self.hits if self.hits else 0.0,
+            "avg_miss_ms": 1000 * self.miss_seconds / self.misses if self.misses else 0.0,
+        }
+
+
+response_cache = ResponseCache(db)
+
+# --- CONVERSATION MEMORY ---
+# Layer 4 sends the latest exchanges along with each question so follow-ups
+# ("and how tall is it?") make sense. What gets sent is capped at
+# CONTEXT_TOKEN_BUDGET; exchanges that fall out of that window are folded
+# into a short running summary on LLM_POOL, never on the request path.
+CONTEXT_TOKEN_BUDGET = int(os.getenv("NEON_CONTEXT_TOKENS", "800"))
+CONTEXT_SUMMARY_WORDS = 80
+CONTEXT_IDLE_SECONDS = 30 * 60  # a question after this long starts a new conversation
+
+# Only counted for the stats; the answer cache keys on the previous question instead
+FOLLOW_UP_WORDS = {"it", "its", "he", "she", "him", "her", "his", "hers", "they", "them", "their"}
+FOLLOW_UP_MAX_WORDS = 6  # longer questions usually name what they are about
+FOLLOW_UP_PREFIXES = ("and ", "but ", "what about", "how about", "what else", "why is that", "why not")
+
+SUMMARY_PROMPT = (
+    "Below is a summary of a voice conversation with the user, followed by newer exchanges. "
+    "Rewrite the summary so it also covers the newer exchanges, in at most {words} words. "
+    "Keep names, facts and open questions the user may refer back to. "
+    "Reply with the summary only.\n\nSummary:\n{summary}\n\nNewer exchanges:\n{turns}"
+)
+
+
+def estimate_tokens(text):
+    """Rough token count (about four characters each), close enough for a budget."""
+    return len(text) // 4 + 1
+
+
+def is_follow_up(text):
+    """True for questions that lean on what was said before ("when was she born?")."""
+    words = tokenize(text)
+    if " ".join(words).startswith(FOLLOW_UP_PREFIXES):
+        return True
+    return len(words) <= FOLLOW_UP_MAX_WORDS and bool(FOLLOW_UP_WORDS & set(words))
+
+
+class Conversation:
+    """One user's latest exchanges, plus a summary of the ones before them."""
+
+    def __init__(self, store, user_id, summary="", turns=None):
+        self.store = store
+        self.user_id = user_id
+        self.summary = summary
+        self.turns = turns or []  # [(row id, question, reply, time)]
+        self._lock = threading.Lock()
+        self._compacting = False
+
+    def active(self, now=None):
+        """Whether the last exchange is recent enough to follow on from."""
+        now = now or time.time()
+        return bool(self.turns) and now - self.turns[-1][3] < CONTEXT_IDLE_SECONDS
+
+    def last_question(self):
+        """The question a new one would follow on from, or None outside a conversation."""
+        with self._lock:
+            return self.turns[-1][1] if self.active() else None
+
+    def history(self):
+        """
+        Context for the next request in Gemini's contents format: the summary
+        and as many of the latest exchanges as fit in the token budget.
+        Returns (contents, tokens).
+        """
+        with self._lock:
+            if not self.active():
+                return [], 0
+            contents, used = [], 0
+            for _, question, reply, _ in reversed(self.turns):
+                cost = estimate_tokens(question) + estimate_tokens(reply)
+                if used + cost > self.store.budget:
+                    break
+                contents[:0] = [{"role": "user", "parts": [question]}, {"role": "model", "parts": [reply]}]
+                used += cost
+            if self.summary and used + estimate_tokens(self.summary) <= self.store.budget:
+                contents[:0] = [{"role": "user", "parts": ["Earlier in our conversation: " + self.summary]},
+                                {"role": "model", "parts": ["Okay."]}]
+                used += estimate_tokens(self.summary)
+            return contents, used
+
+    def add(self, question, reply):
+        if self.store.budget <= 0:
+            return  # context is off, nothing would ever be sent
+        now = time.time()
+        with self._lock:
+            if not self.active(now):
+                self.summary = ""
+                self.turns = []
+                self.store.clear(self.user_id)
+            self.turns.append((self.store.append(self.user_id, question, reply, now), question, reply, now))
+            old = self._overflow()
+            if not old or self._compacting:
+                return
+            if not API_KEY:
+                self._trim()
+                return
+            self._compacting = True
+        try:
+            LLM_POOL.submit(self._compact, old)
+        except Overloaded:
+            with self._lock:
+                self._compacting = False
+                self._trim()
+
+    def _overflow(self):
+        """The oldest exchanges that no longer fit next to a full-size summary."""
+        room = self.store.budget - 2 * CONTEXT_SUMMARY_WORDS
+        used = keep = 0
+        for _, question, reply, _ in reversed(self.turns):
+            used += estimate_tokens(question) + estimate_tokens(reply)
+            if keep and used > room:
+                break
+            keep += 1
+        return self.turns[:len(self.turns) - keep]
+
+    def _trim(self):
+        """Drops the exchanges history() can no longer send, when they can't be summarized."""
+        used = keep = 0
+        for _, question, reply, _ in reversed(self.turns):
+            used += estimate_tokens(question) + estimate_tokens(reply)
+            if used > self.store.budget:
+                break
+            keep += 1
+        dropped = self.turns[:len(self.turns) - keep]
+        if dropped:
+            self.turns = self.turns[len(dropped):]
+            self.store.drop(self.user_id, dropped[-1][0])
+
+    def _compact(self, old):
+        try:
+            turns = "\n".join(f"User: {q}\nAssistant: {r}" for _, q, r, _ in old)
+            prompt = SUMMARY_PROMPT.format(words=CONTEXT_SUMMARY_WORDS, summary=self.summary or "(nothing yet)",
+                                           turns=turns)
+            started = time.perf_counter()
+            summary = clean_markdown(get_llm_model().generate_content(prompt).text)
+            tracer.observe("llm.summarize", time.perf_counter() - started)
+            ids = {row_id for row_id, _, _, _ in old}
+            with self._lock:
+                # The conversation may have been restarted while this ran
+                if not summary or not ids & {row_id for row_id, _, _, _ in self.turns}:
+                    return
+                self.summary = summary
+                self.turns = [t for t in self.turns if t[0] not in ids]
+                self.store.fold(self.user_id, summary, max(ids))
+        except Exception as e:
+            print(f"Conversation Summary Error: {e}")
+        finally:
+            self._compacting = False
+
+
+class ConversationStore:
+    """
+    Conversations kept in user_data.db: a row per exchange still in the
+    window and a summary row per user. Exchanges are deleted once they are
+    folded into the summary, so the tables stay small.
+    """
+
+    def __init__(self, db, budget=CONTEXT_TOKEN_BUDGET):
+        self.db = db
+        self.budget = budget
+        self.requests = 0
+        self.follow_ups = 0
+        self.context_tokens = 0
+        self._loaded = {}
+        self._lock = threading.Lock()
+
+    @property
+    def conn(self):
+        return self.db.connection(self.create_tables)
+
+    def create_tables(self, conn):
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS conversations (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                question TEXT,
+                reply TEXT,
+                created_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS idx_conversations_user ON conversations(user_id, id);
+            CREATE TABLE IF NOT EXISTS conversation_summaries (
+                user_id INTEGER PRIMARY KEY,
+                summary TEXT,
+                updated_at REAL
+            );
+        """)
+        conn.commit()
+
+    def get(self, user_id):
+        """The user's Conversation, loaded from the database the first time."""
+        with self._lock:
+            conversation = self._loaded.get(user_id)
+            if conversation is None:
+                row = self.conn.execute(
+                    "SELECT summary FROM conversation_summaries WHERE user_id = ?", (user_id,)).fetchone()
+                turns = self.conn.execute(
+                    "SELECT id, question, reply, created_at FROM conversations WHERE user_id = ? ORDER BY id",
+                    (user_id,)).fetchall()
+                conversation = Conversation(self, user_id, row[0] if row else "", [tuple(t) for t in turns])
+                self._loaded[user_id] = conversation
+            return conversation
+
+    def append(self, user_id, question, reply, now):
+        cursor = self.conn.execute(
+            "INSERT INTO conversations (user_id, question, reply, created_at) VALUES (?, ?, ?, ?)",
+            (user_id, question, reply, now))
+        self.conn.commit()
+        return cursor.lastrowid
+
+    def fold(self, user_id, summary, upto_id):
+        """Stores the new summary and drops the exchanges it now covers."""
+        self.conn.execute("INSERT OR REPLACE INTO conversation_summaries VALUES (?, ?, ?)",
+                          (user_id, summary, time.time()))
+        self.conn.execute("DELETE FROM conversations WHERE user_id = ? AND id <= ?", (user_id, upto_id))
+        self.conn.commit()
+
+    def drop(self, user_id, upto_id):
+        """Deletes the exchanges up to upto_id without touching the summary."""
+        self.conn.execute("DELETE FROM conversations WHERE user_id = ? AND id <= ?", (user_id, upto_id))
+        self.conn.commit()
+
+    def clear(self, user_id):
+        self.conn.execute("DELETE FROM conversation_summaries WHERE user_id = ?", (user_id,))
+        self.conn.execute("DELETE FROM conversations WHERE user_id = ?", (user_id,))
+        self.conn.commit()
+
+    def record(self, tokens, follow_up):
+        self.requests += 1
+        self.context_tokens += tokens
+        self.follow_ups += bool(follow_up)
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "follow_ups": self.follow_ups,
+            "avg_context_tokens": self.context_tokens / self.requests if self.requests else 0.0,
+            "budget": self.budget,
+        }
+
+
+conversations = ConversationStore(db)
+
+# --- AI & VOICE LOGIC (THREADED) ---
+_NOT_ROUTED = object()
+
+def process_voice_command(command_text, page, status_control, match=_NOT_ROUTED, cancel=None, trace_id=None,
+                          session=None, reply=None):
+    """
+    Runs one command through the layers below. match can be passed in if the
+    command was already routed; setting cancel (a threading.Event) makes the
+    rest of the command a no-op and stops a streaming reply. trace_id tags
+    the timings recorded on the way. session is the user's AppState (the
+    desktop one by default); web sessions speak and open links in the browser.
+    reply is a Gemini reply to the command already on its way (speculation).
+    Returns the action taken: "site", "time", "date", "app", "youtube",
+    "song", "cache", "llm", "no_answer", "no_key", "busy", "error" or
+    "cancelled".
+    """
+    command = command_text.lower()
+    print(f"DEBUG: Processing command: {command}")
+    session = session or state
+    speaker = session.speaker or speech
+    executor = session.actions or actions
+    
+    def cancelled():
+        return cancel is not None and cancel.is_set()
+    
+    def status(text, is_active=False):
+        if page is not None and not cancelled():
+            update_status(page, status_control, text, is_active)
+    
+    def say(text):
+        if not cancelled():
+            speaker.say(text, trace_id=trace_id).wait()
+    
+    def run_action(kind, payload, failure):
+        """Hands a side effect to the action executor; failure is shown if it doesn't work out."""
+        def done(future):
+            if future.exception() is not None:
+                status(failure)
+        try:
+            executor.run(kind, payload, on_done=done, trace_id=trace_id)
+        except Overloaded:
+            status(failure)
+
+    def open_url(url):
+        if session.web:
+            ui_for(page).call(page.launch_url, url)
+        else:
+            run_action("open_url", url, "Couldn't open the browser.")
+    
+    if match is _NOT_ROUTED:
+        with tracer.stage("route", trace_id):
+            match = router.route(command)
+    kind = match.kind if match else None
+    
+    # --- LAYER 1: WEBSITE SHORTCUTS (SMART MATCHING) ---
+    # Opens if the command contains "open"/"launch" OR is JUST the site name (mic cutoff)
+    if kind == "site":
+        site_name = match.intent.key.title()
+        status(f"Opening {site_name}...", is_active=True)
+        open_url(match.intent.payload)
+        say(f"Opening {site_name}")
+        status("Idle - Assistant On")
+        return "site"
+
+    # --- LAYER 1.5: TIME & DATE ---
+    if kind == "time":
+        current_time = datetime.datetime.now().strftime("%I:%M %p") 
+        status(f"Time: {current_time}", is_active=True)
+        say(f"The time is {current_time}")
+        status("Idle - Assistant On")
+        return "time"
+
+    if kind == "date":
+        current_date = datetime.datetime.now().strftime("%A, %B %d, %Y")
+        status(f"Date: {current_date}", is_active=True)
+        say(f"Today is {current_date}")
+        status("Idle - Assistant On")
+        return "date"
+
+    # --- LAYER 2: SYSTEM APPS ---
+    if kind == "app":
+        app_name = match.intent.key.replace("open ", "").title()
+        if session.web:
+            status(f"{app_name} can only be opened in the desktop app.")
+            say(f"I can only open {app_name} in the desktop app.")
+            return "app"
+        status(f"Opening {app_name}...", is_active=True)
+        run_action("launch_app", match.intent.payload, f"Couldn't open {app_name}.")
+        say(f"Opening {app_name}")
+        status("Idle - Assistant On")
+        return "app"
+
+    # --- LAYER 3: MUSIC PLAYER (SMART LIBRARY PRIORITY) ---
+    song = catalog.find_in_text(command)
+
+    if song is None and "play" in command:
+        query = command.replace("play", "").strip()
+        best = catalog.search(query, limit=1) if query else []
+        if best:
+            song = best[0][1:]
+        elif query:
+            response_text = f"Playing {query} on YouTube..."
+            status(response_text, is_active=True)
+            open_url(f"https://www.youtube.com/results?search_query={query}")
+            say(f"Playing {query}")
+            status("Idle - Assistant On")
+            return "youtube"
+
+    if song is not None:
+        song_key, song_url = song
+        response_text = f"Playing {song_key} from Library..."
+        status(response_text, is_active=True)
+        open_url(song_url)
+        say(f"Playing {song_key}")
+        status("Idle - Assistant On")
+        return "song"
+
+    # --- LAYER 4: AI INTELLIGENCE ---
+    try:
+        status("Thinking...", is_active=True)
+        
+        user_id = session.current_user.id if session.current_user else 0
+        conversation = conversations.get(user_id)
+        # Inside a conversation answers are cached per preceding question, so
+        # "why is that?" never gets an answer meant for another conversation
+        context = conversation.last_question()
+        follow_up = context is not None and is_follow_up(command)
+        started = time.perf_counter()
+        cached_reply = None if reply is not None else response_cache.get(user_id, command, context)
+        
+        if cached_reply:
+            response_cache.record(True, time.perf_counter() - started)
+            tracer.observe("llm.cache_hit", time.perf_counter() - started, trace_id)
+            print("DEBUG: Answer served from cache.")
+            status(cached_reply, is_active=True)
+            say(cached_reply)
+            conversation.add(command, cached_reply)
+            return "cache"
+        elif API_KEY:
+            if reply is None:
+                history, context_tokens = conversation.history()
+                conversations.record(context_tokens, follow_up)
+                reply = LLM_POOL.stream(stream_reply, command, cancel, history)
+            # Speak each sentence as soon as it arrives; the rest keeps generating
+            spoken = []
+            utterances = []
+            for sentence in reply:
+                if cancelled():
+                    break
+                if not spoken:
+                    response_cache.record(False, time.perf_counter() - started)
+                    tracer.observe("llm.first_sentence", time.perf_counter() - started, trace_id)
+                spoken.append(sentence)
+                status(" ".join(spoken), is_active=True)
+                utterances.append(speaker.say(sentence, trace_id=trace_id))
+            tracer.observe("llm.total", time.perf_counter() - started, trace_id)
+            
+            if cancelled():
+                return "cancelled"
+            if spoken:
+                answer = " ".join(spoken)
+                response_cache.put(user_id, command, answer, context)
+                conversation.add(command, answer)
+            else:
+                clean_reply = "Sorry, I don't have an answer for that."
+                status(clean_reply, is_active=True)
+                utterances.append(speaker.say(clean_reply, trace_id=trace_id))
+            
+            for utt in utterances:
+                utt.wait()
+            return "llm" if spoken else "no_answer"
+        else:
+            clean_reply = "I cannot find my API key."
+            status(clean_reply, is_active=True)
+            say(clean_reply)
+            return "no_key"
+    
+    except Overloaded as e:
+        print(f"DEBUG: Busy, turning a request away ({e})")
+        busy_msg = "I'm handling a lot of requests right now. Please try again in a moment."
+        status(busy_msg)
+        try:
+            say(busy_msg)
+        except Overloaded:
+            pass
+        return "busy"
+
+    except Exception as e:
+        print(f"AI Error: {e}")
+        error_msg = "I'm having trouble connecting to the server."
+        status(error_msg)
+        say(error_msg)
+        return "error"
+
+def submit_command(session, text, page, status_control):
+    """
+    Runs a typed command for session on COMMAND_POOL and returns its future.
+    A newer command cancels the one still in flight, like a barge-in.
+    Raises Overloaded when the pool is full.
+    """
+    cancel_command(session)
+    cancel = threading.Event()
+    trace_id = tracer.new_interaction()
+    submitted_ns = time.perf_counter_ns()
+    future = COMMAND_POOL.submit(_run_command, session, text, page, status_control, cancel, trace_id, submitted_ns)
+    session.active = (future, cancel)
+    return future
+
+
+def _run_command(session, text, page, status_control, cancel, trace_id, submitted_ns):
+    tracer.record("queue.command", submitted_ns, time.perf_counter_ns(), trace_id)
+    try:
+        with tracer.stage("act", trace_id):
+            process_voice_command(text, page, status_control, cancel=cancel, trace_id=trace_id, session=session)
+    except Overloaded as e:
+        print(f"DEBUG: Busy, turning a request away ({e})")
+        update_status(page, status_control, "Busy right now, please try again in a moment.")
+        return
+    if not cancel.is_set():
+        tracer.record("interaction", submitted_ns, time.perf_counter_ns(), trace_id)
+        update_status(page, status_control, "Idle - Assistant On")
+
+
+def cancel_command(session):
+    """Stops the session's typed command in flight and anything it still has to say."""
+    if session.active is not None:
+        future, cancel = session.active
+        cancel.set()
+        future.cancel()
+        session.active = None
+    if session.speaker is not None:
+        session.speaker.cancel_all()
+
+
+def cache_summary():
+    s = response_cache.stats()
+    return (f"Answer cache: {s['hits']} hits / {s['misses']} misses ({s['hit_rate']:.0%}), "
+            f"{s['avg_hit_ms']:.0f} ms vs {s['avg_miss_ms']:.0f} ms, {s['entries']} stored")
+
+
+def context_summary():
+    s = conversations.stats()
+    return (f"Conversation context: {s['avg_context_tokens']:.0f} tokens per request on average "
+            f"(budget {s['budget']}), {s['follow_ups']} follow-ups")
+
+# --- UI UPDATE SCHEDULER ---
+UI_MAX_FPS = 15
+
+
+class UiScheduler:
+    """
+    Background threads queue control changes here instead of touching page.
+    A flusher thread applies them at most UI_MAX_FPS times a second and sends
+    only the controls that actually changed, in one page.update(*controls)
+    call. A value that gets overwritten before the next flush is never sent.
+    Page calls that aren't attribute changes (play a clip, open a URL) are
+    queued with call() and run in order right after that update.
+    """
+
+    def __init__(self, page, fps=UI_MAX_FPS):
+        self.page = page
+        self.interval = 1.0 / fps
+        self._pending = {}
+        self._calls = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._closed = False
+        self.flushes = 0
+        self.superseded = 0
+
+    def set(self, control, **attrs):
+        """Queues attribute changes for control; the latest value per attribute wins."""
+        with self._lock:
+            entry = self._pending.get(id(control))
+            if entry is None:
+                self._pending[id(control)] = (control, dict(attrs))
+            else:
+                self.superseded += len(entry[1].keys() & attrs.keys())
+                entry[1].update(attrs)
+            self._start()
+        self._wake.set()
+
+    def call(self, fn, *args):
+        """Queues fn(*args) for the flusher thread, after the changes queued before it."""
+        with self._lock:
+            self._calls.append((fn, args))
+            self._start()
+        self._wake.set()
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="ui-flush", daemon=True)
+            self._thread.start()
+
+    def close(self):
+        """Stops the flusher thread; later changes are dropped."""
+        self._closed = True
+        self._wake.set()
+
+    def _run(self):
+        last_flush = 0.0
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            if self._closed:
+                return
+            # Anything queued while we wait here is folded into the same flush
+            delay = last_flush + self.interval - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"UI Update Error: {e}")
+            last_flush = time.monotonic()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            calls, self._calls = self._calls, []
+        changed = []
+        for control, attrs in pending.values():
+            dirty = False
+            for name, value in attrs.items():
+                if getattr(control, name, None) != value:
+                    setattr(control, name, value)
+                    dirty = True
+            if dirty:
+                changed.append(control)
+        if changed:
+            self.flushes += 1
+            self.page.update(*changed)
+        for fn, args in calls:
+            try:
+                fn(*args)
+            except Exception as e:
+                print(f"UI Update Error: {e}")
+
+
+_ui_schedulers = {}
+_ui_schedulers_lock = threading.Lock()
+
+
+def ui_for(page):
+    """The UiScheduler for page, created on first use."""
+    with _ui_schedulers_lock:
+        ui = _ui_schedulers.get(id(page))
+        if ui is None or ui.page is not page:
+            ui = _ui_schedulers[id(page)] = UiScheduler(page)
+        return ui
+
+
+def drop_ui(page):
+    """Forgets page's UiScheduler and stops its thread, once the page is gone."""
+    with _ui_schedulers_lock:
+        ui = _ui_schedulers.pop(id(page), None)
+    if ui is not None and ui.page is page:
+        ui.close()
+
+
+def update_status(page, control, text, is_active=False):
+    ui_for(page).set(control, value=text, color="cyanAccent" if is_active else "grey400")
+
+# --- WAKE WORD SPOTTER (LOCAL) ---
+WAKE_SAMPLE_RATE = 16000
+WAKE_FRAME_SAMPLES = 480  # 30 ms frames
+WAKE_KWS_THRESHOLD = 1e-20
+
+
+def _make_kws_decoder(phrase, threshold):
+    """Builds a pocketsphinx decoder in keyword-spotting mode (old and new API)."""
+    if hasattr(SphinxDecoder, "default_config"):
+        from pocketsphinx import get_model_path
+        model_path = get_model_path()
+        config = SphinxDecoder.default_config()
+        config.set_string("-hmm", os.path.join(model_path, "en-us"))
+        config.set_string("-dict", os.path.join(model_path, "cmudict-en-us.dict"))
+        config.set_string("-keyphrase", phrase)
+        config.set_float("-kws_threshold", threshold)
+        config.set_string("-logfn", os.devnull)
+        return SphinxDecoder(config)
+    return SphinxDecoder(keyphrase=phrase, kws_threshold=threshold, loglevel="FATAL")
+
+
+class WakeWordSpotter:
+    """
+    Streaming keyword spotter running pocketsphinx on the CPU over short frames.
+    Only a hit escalates to full speech-to-text. If pocketsphinx is missing or the
+    wake word is not in its dictionary, available is False and the listener
+    falls back to checking Google transcripts.
+    """
+
+    def __init__(self, threshold=WAKE_KWS_THRESHOLD, sample_rate=WAKE_SAMPLE_RATE):
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.keyphrase = None
+        self.decoder = None
+        self._utt_samples = 0
+        # Stats
+        self.audio_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.detections = 0
+        self.latencies = []
+
+    @property
+    def available(self):
+        return self.decoder is not None
+
+    @property
+    def cpu_load(self):
+        """CPU seconds spent per second of audio (1.0 = one full core)."""
+        return self.cpu_seconds / self.audio_seconds if self.audio_seconds else 0.0
+
+    def set_keyphrase(self, phrase):
+        phrase = (phrase or "").strip().lower()
+        if phrase == self.keyphrase:
+            return self.available
+        self.keyphrase = phrase
+        self.decoder = None
+        if load_sphinx() is None or not phrase:
+            return False
+        try:
+            decoder = _make_kws_decoder(phrase, self.threshold)
+        except Exception as e:
+            print(f"Wake Spotter Error: {e}")
+            return False
+
+        missing = [w for w in phrase.split() if not decoder.lookup_word(w)]
+        if missing:
+            print(f"WARNING: {missing} not in local dictionary, using cloud wake word check.")
+            return False
+
+        self.decoder = decoder
+        self.reset()
+        return True
+
+    def reset(self):
+        try:
+            self.decoder.end_utt()
+        except Exception:
+            pass
+        self.decoder.start_utt()
+        self._utt_samples = 0
+
+    def process(self, frame):
+        """Feeds one frame of 16-bit mono PCM. Returns True on a wake word hit."""
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        self.decoder.process_raw(bytes(frame), False, False)
+        hit = self.decoder.hyp() is not None
+
+        samples = len(frame) // 2
+        self._utt_samples += samples
+        self.audio_seconds += samples / self.sample_rate
+        self.cpu_seconds += time.thread_time() - cpu_start
+
+        if hit:
+            # How far behind the end of the keyword we noticed it, plus decode time
+            now_s = self._utt_samples / self.sample_rate
+            end_s = now_s
+            try:
+                end_s = max(seg.end_frame for seg in self.decoder.seg()) / 100.0
+            except Exception:
+                pass
+            self.latencies.append(max(0.0, now_s - end_s) + (time.perf_counter() - wall_start))
+            self.detections += 1
+            self.reset()
+        return hit
+
+    def scan_wav(self, path):
+        """Runs the spotter over a recorded WAV file. Returns hit offsets in seconds."""
+        hits = []
+        fed = 0
+        for frame in _read_wav_frames(path, self.sample_rate, WAKE_FRAME_SAMPLES):
+            fed += len(frame) // 2
+            if self.process(frame):
+                hits.append(fed / self.sample_rate)
+        return hits
+
+
+# audioop is gone in Python 3.13, so the little PCM work needed here is
+# done with array instead.
+def pcm16_rms(data):
+    """RMS energy of a 16-bit PCM frame."""
+    samples = array("h")
+    samples.frombytes(data[:len(data) - len(data) % 2])
+    if not samples:
+        return 0
+    return int(math.sqrt(sum(x * x for x in samples) / len(samples)))
+
+
+def to_pcm16(data, width, channels, rate, sample_rate):
+    """Converts WAV sample data to 16-bit mono PCM at sample_rate."""
+    if width == 1:
+        samples = array("h", ((b - 128) << 8 for b in data))  # 8-bit WAV is unsigned
+    elif width == 2:
+        samples = array("h")
+        samples.frombytes(data)
+    elif width == 3:
+        samples = array("h", (int.from_bytes(data[i:i + 3], "little", signed=True) >> 8
+                              for i in range(0, len(data) - 2, 3)))
+    elif width == 4:
+        wide = array("i")
+        wide.frombytes(data)
+        samples = array("h", (x >> 16 for x in wide))
+    else:
+        raise ValueError(f"Unsupported sample width: {width}")
+    if channels > 1:
+        samples = array("h", (sum(samples[i:i + channels]) // channels
+                              for i in range(0, len(samples) - channels + 1, channels)))
+    if rate != sample_rate and samples:
+        # Linear interpolation is plenty for speech going into a recognizer
+        count = int(len(samples) * sample_rate / rate)
+        last = len(samples) - 1
+        resampled = array("h", [0]) * count
+        for i in range(count):
+            pos = i * rate / sample_rate
+            j = int(pos)
+            nxt = samples[min(j + 1, last)]
+            resampled[i] = int(samples[j] + (nxt - samples[j]) * (pos - j))
+        samples = resampled
+    return samples.tobytes()
+
+
+def _read_wav_frames(path, sample_rate, frame_samples):
+    """Yields 16-bit mono frames from a WAV, converting rate/channels if needed."""
+    with wave.open(path, "rb") as wf:
+        width, channels, rate = wf.getsampwidth(), wf.getnchannels(), wf.getframerate()
+        data = wf.readframes(wf.getnframes())
+    data = to_pcm16(data, width, channels, rate, sample_rate)
+    step = frame_samples * 2
+    for i in range(0, len(data) - step + 1, step):
+        yield data[i:i + step]
+
+
+# --- AUDIO CAPTURE ---
+CAPTURE_BUFFER_SECONDS = 30
+PRE_ROLL_SECONDS = 0.75
+SPEECH_PADDING_SECONDS = 0.3
+ECHO_TAIL_SECONDS = 0.1  # our own prompt is still coming back from the room this long after it ends
+
+# --- VOICE ACTIVITY DETECTION ---
+# Frame energies (RMS) against a noise floor that is tracked all the time,
+# instead of a threshold measured once at startup.
+VAD_MIN_ENERGY = 60            # never speech below this (digital silence, mic hiss)
+VAD_ONSET_RATIO = 3.0          # ~10 dB over the noise floor starts speech...
+VAD_OFFSET_RATIO = 2.0         # ...and ~6 dB keeps it going (hysteresis)
+VAD_ONSET_SECONDS = 0.09       # this long above onset before it counts as speech
+VAD_HANGOVER_SECONDS = 0.4     # trailing silence that ends an utterance
+VAD_MIN_SPEECH_SECONDS = 0.2   # shorter bursts (clicks, knocks) are ignored
+VAD_PRIME_SECONDS = 0.3        # audio needed before the floor is trusted
+NOISE_ADAPT_QUIET = 0.05       # per-frame floor adaptation on non-speech frames
+NOISE_ADAPT_LOUD = 0.0005      # and on loud ones, so a new steady noise is learned within a minute
+
+
+class NoiseFloor:
+    """
+    Running estimate of the background energy, following quiet frames
+    quickly and loud ones slowly. Only frames below the offset level count
+    as quiet, so steady speech just above it can't drag the floor up to
+    itself and end the utterance early.
+    """
+
+    def __init__(self):
+        self.level = None
+
+    def update(self, energy):
+        if self.level is None:
+            self.level = float(max(energy, 1))
+            return
+        rate = NOISE_ADAPT_QUIET if energy < self.level * VAD_OFFSET_RATIO else NOISE_ADAPT_LOUD
+        self.level += (energy - self.level) * rate
+
+    @property
+    def onset(self):
+        return max(VAD_MIN_ENERGY, (self.level or 0) * VAD_ONSET_RATIO)
+
+    @property
+    def offset(self):
+        return max(VAD_MIN_ENERGY, (self.level or 0) * VAD_OFFSET_RATIO)
+
+
+class Endpointer:
+    """
+    Start/end of one utterance, decided frame by frame: speech starts after
+    VAD_ONSET_SECONDS above the onset level and ends VAD_HANGOVER_SECONDS
+    after the last frame above the offset level. Bursts shorter than
+    VAD_MIN_SPEECH_SECONDS are dropped and the search starts over.
+    """
+    START = "start"
+    END = "end"
+
+    def __init__(self, noise, frame_seconds, hangover=VAD_HANGOVER_SECONDS):
+        self.noise = noise
+        self.onset_frames = max(1, int(round(VAD_ONSET_SECONDS / frame_seconds)))
+        self.hangover_frames = max(1, int(round(hangover / frame_seconds)))
+        self.min_speech_frames = max(1, int(round(VAD_MIN_SPEECH_SECONDS / frame_seconds)))
+        self.start_index = None
+        self.last_voiced = None
+        self._run = 0
+
+    @property
+    def in_speech(self):
+        return self.start_index is not None
+
+    def push(self, index, energy):
+        """Feeds one frame's energy. Returns START, END or None."""
+        if self.start_index is None:
+            if energy > self.noise.onset:
+                self._run += 1
+                if self._run >= self.onset_frames:
+                    self.start_index = index - self._run + 1
+                    self.last_voiced = index
+                    return self.START
+            else:
+                self._run = 0
+            return None
+
+        if energy > self.noise.offset:
+            self.last_voiced = index
+        elif index - self.last_voiced >= self.hangover_frames:
+            if self.last_voiced - self.start_index + 1 >= self.min_speech_frames:
+                return self.END
+            self.start_index = self.last_voiced = None
+            self._run = 0
+        return None
+
+
+class AudioRingBuffer:
+    """
+    Fixed-size, preallocated ring of PCM frames with a single writer.
+    write_index counts every frame ever written and is only bumped after the
+    frame is in place, so readers need no lock: they keep their own cursor and
+    get memoryviews straight into the buffer (no copies). A view stays valid
+    until the writer laps it, i.e. for capacity frames.
+    """
+
+    def __init__(self, frame_bytes, capacity_frames):
+        self.frame_bytes = frame_bytes
+        self.capacity = capacity_frames
+        self._buf = bytearray(frame_bytes * capacity_frames)
+        self._view = memoryview(self._buf)
+        self.write_index = 0
+
+    def write(self, data):
+        data = data[:self.frame_bytes]
+        slot = (self.write_index % self.capacity) * self.frame_bytes
+        self._view[slot:slot + len(data)] = data
+        if len(data) < self.frame_bytes:
+            self._view[slot + len(data):slot + self.frame_bytes] = bytes(self.frame_bytes - len(data))
+        self.write_index += 1
+
+    @property
+    def oldest_index(self):
+        return max(0, self.write_index - self.capacity)
+
+    def frame(self, index):
+        """Zero-copy view of one frame, or None if not written yet / overwritten."""
+        if index < self.oldest_index or index >= self.write_index:
+            return None
+        slot = (index % self.capacity) * self.frame_bytes
+        return self._view[slot:slot + self.frame_bytes]
+
+    def span(self, start, end):
+        """Frames [start, end) as at most two contiguous views (split at the wrap)."""
+        start = max(start, self.oldest_index)
+        end = min(end, self.write_index)
+        if end <= start:
+            return []
+        a = (start % self.capacity) * self.frame_bytes
+        b = (end % self.capacity) * self.frame_bytes
+        if b > a:
+            return [self._view[a:b]]
+        return [self._view[a:], self._view[:b]] if b else [self._view[a:]]
+
+
+def _open_microphone():
+    return sr.Microphone(sample_rate=WAKE_SAMPLE_RATE, chunk_size=WAKE_FRAME_SAMPLES)
+
+
+class AudioCapture:
+    """
+    One persistent microphone stream feeding an AudioRingBuffer. The device is
+    opened once and stays open while the assistant is switched on and off.
+    """
+
+    def __init__(self, source_factory=_open_microphone, sample_rate=WAKE_SAMPLE_RATE,
+                 frame_samples=WAKE_FRAME_SAMPLES, seconds=CAPTURE_BUFFER_SECONDS):
+        self.source_factory = source_factory
+        self.sample_rate = sample_rate
+        self.sample_width = 2
+        self.frame_samples = frame_samples
+        self.frame_seconds = frame_samples / float(sample_rate)
+        self.ring = AudioRingBuffer(frame_samples * 2, int(seconds / self.frame_seconds))
+        # Per frame, alongside the ring: RMS energy and arrival time
+        self._energy = array("f", [0.0]) * self.ring.capacity
+        self._arrival_ns = array("q", [0]) * self.ring.capacity
+        self.noise = NoiseFloor()
+        self.error = None
+        self.running = False
+        self._new_frame = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self.running = True
+            self._thread = threading.Thread(target=self._run, name="capture", daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self):
+        try:
+            with self.source_factory() as mic:
+                while self.running:
+                    data = mic.stream.read(mic.CHUNK)
+                    if not data:
+                        break
+                    # Stored before the frame is published, so readers never see a stale value
+                    slot = self.ring.write_index % self.ring.capacity
+                    energy = pcm16_rms(data)
+                    self._energy[slot] = energy
+                    self._arrival_ns[slot] = time.perf_counter_ns()
+                    self.noise.update(energy)
+                    self.ring.write(data)
+                    with self._new_frame:
+                        self._new_frame.notify_all()
+        except Exception as e:
+            self.error = e
+            print(f"Capture Error: {e}")
+        finally:
+            self.running = False
+            with self._new_frame:
+                self._new_frame.notify_all()
+
+    def stop(self):
+        self.running = False
 
-# --- VOICE ENGINE SETUP ---
-def speak_text(text):
+    def seconds_to_frames(self, seconds):
+        return int(round(seconds / self.frame_seconds))
+
+    def energy(self, index):
+        return self._energy[index % self.ring.capacity]
+
+    def arrival_ns(self, index):
+        """perf_counter_ns() when frame index came off the microphone."""
+        return self._arrival_ns[index % self.ring.capacity]
+
+    def frames_from(self, index):
+        """
+        Yields (index, view) for every frame from index on, blocking for new ones.
+        A reader that fell more than a buffer behind skips to the oldest frame.
+        Ends when the capture stream stops.
+        """
+        while True:
+            if index >= self.ring.write_index:
+                with self._new_frame:
+                    while index >= self.ring.write_index and self.running:
+                        self._new_frame.wait(0.5)
+                if index >= self.ring.write_index:
+                    if self.error is not None:
+                        raise OSError(f"Microphone stopped: {self.error}")
+                    return
+            index = max(index, self.ring.oldest_index)
+            view = self.ring.frame(index)
+            if view is not None:
+                yield index, view
+            index += 1
+
+    def audio_data(self, start, end):
+        """Copies frames [start, end) once into an sr.AudioData for the recognizer."""
+        raw = b"".join(self.ring.span(start, end))
+        return sr.AudioData(raw, self.sample_rate, self.sample_width)
+
+
+def prime_noise_floor(capture, duration=VAD_PRIME_SECONDS):
+    """Waits for duration seconds of audio so the noise floor has settled. False if the mic is dead."""
+    needed = capture.seconds_to_frames(duration)
+    seen = 0
+    for _ in capture.frames_from(capture.ring.write_index):
+        seen += 1
+        if seen >= needed:
+            return True
+    return False
+
+
+def capture_utterance(capture, start, timeout=7, phrase_time_limit=10, on_frame=None, endpointer=None,
+                      echo=None):
     """
-    Safely speaks text with a HARD delay afterwards.
-    Tuned for MAXIMUM VOLUME and CLEAR PRONUNCIATION.
+    VAD endpointing over ring buffer frames starting at start (which may be
+    in the past, i.e. pre-roll). Returns as soon as the speaker stops, i.e.
+    one hangover after the last voiced frame. Timeouts are measured in audio
+    time. on_frame, if given, is called with each frame of the utterance as
+    it arrives (for streaming recognizers). Pass an Endpointer to read
+    last_voiced (the end of speech) afterwards. echo is an optional
+    (start_ns, end_ns) arrival window when the speakers were playing our own
+    speech: frames in it can't start an utterance and aren't part of it.
+    Raises sr.WaitTimeoutError if no speech starts within timeout seconds.
     """
-    try:
-        print(f"DEBUG: Speaking -> {text}")
-        local_engine = pyttsx3.init()
-        
-        voices = local_engine.getProperty('voices')
-        if len(voices) > 1:
-            local_engine.setProperty('voice', voices[1].id)
-        
-        local_engine.setProperty('rate', 140)
-        local_engine.setProperty('volume', 1.0)
-        
-        local_engine.say(text)
-        local_engine.runAndWait() 
-        local_engine.stop()       
-        del local_engine          
-        
-        time.sleep(1.0) 
-        
-    except Exception as e:
-        print(f"TTS Error: {e}")
+    frame_s = capture.frame_seconds
+    padding = capture.seconds_to_frames(SPEECH_PADDING_SECONDS)
+    vad = endpointer or Endpointer(capture.noise, frame_s)
+    begin = None
+    end = start
+    after_echo = start
+    for index, frame in capture.frames_from(start):
+        end = index + 1
+        energy = capture.energy(index)
+        if echo is not None and not vad.in_speech and echo[0] <= capture.arrival_ns(index) < echo[1]:
+            energy = 0
+            after_echo = index + 1
+        event = vad.push(index, energy)
+        if event is Endpointer.START:
+            begin = max(start, after_echo, vad.start_index - padding)
+            if on_frame is not None:
+                for earlier in range(begin, index):
+                    view = capture.ring.frame(earlier)
+                    if view is not None:
+                        on_frame(view)
+        if not vad.in_speech:
+            if (index - start) * frame_s >= timeout:
+                raise sr.WaitTimeoutError("listening timed out while waiting for phrase to start")
+            continue
+        if on_frame is not None:
+            on_frame(frame)
+        if event is Endpointer.END or (index - vad.start_index) * frame_s >= phrase_time_limit:
+            break
+    if not vad.in_speech:
+        raise sr.WaitTimeoutError("audio stream ended before a phrase started")
+    return capture.audio_data(begin, end)
+
+# --- SPEECH TO TEXT BACKENDS ---
+# Which engine transcribes commands: per user (users.stt_backend) or the
+# STT_BACKEND default. When the cloud engine can't be reached the command is
+# retried on STT_FALLBACK, a local engine, instead of being lost.
+STT_BACKEND = os.getenv("STT_BACKEND", "google")
+STT_FALLBACK = os.getenv("STT_FALLBACK", "vosk")
+VOSK_MODEL_PATH = os.getenv("VOSK_MODEL_PATH", os.path.join("models", "vosk-model-small-en-us-0.15"))
+
+
+class SttBackend:
+    """
+    Turns speech into text. transcribe() takes a finished sr.AudioData;
+    backends with streaming = True also offer open_stream() for partial
+    results while the user is still talking. Errors follow speech_recognition:
+    UnknownValueError for no speech, RequestError for an unreachable service.
+    """
+    name = None
+    local = False
+    streaming = False
+
+    def available(self):
+        return True
+
+    def load(self):
+        """Loads models etc. ahead of the first command."""
+
+    def transcribe(self, audio):
+        raise NotImplementedError
+
+    def open_stream(self, sample_rate=WAKE_SAMPLE_RATE):
+        raise NotImplementedError
+
+
+class GoogleStt(SttBackend):
+    """The free Google Web Speech API via speech_recognition (needs the network)."""
+    name = "google"
 
-# --- DATABASE MANAGER ---
-class Database:
     def __init__(self):
-        self.conn = sqlite3.connect("user_data.db", check_same_thread=False)
-        self.create_table()
+        self._recognizer = None
 
-    def create_table(self):
-        cursor = self.conn.cursor()
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                email TEXT UNIQUE,
-                password TEXT,
-                first_name TEXT,
-                last_name TEXT,
-                age INTEGER,
-                occupation_type TEXT,
-                institution_or_company TEXT,
-                wake_word TEXT DEFAULT 'hey alexa'
-            )
-        """)
-        self.conn.commit()
+    def load(self):
+        if self._recognizer is None:
+            self._recognizer = sr.Recognizer()
+        return self._recognizer
 
-    def register_user(self, email, password, fname, lname, age, occ_type, place):
-        cursor = self.conn.cursor()
-        try:
-            cursor.execute("""
-                INSERT INTO users (email, password, first_name, last_name, age, occupation_type, institution_or_company)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            """, (email, password, fname, lname, age, occ_type, place))
-            self.conn.commit()
-            return True
-        except sqlite3.IntegrityError:
-            return False
+    def transcribe(self, audio):
+        return self.load().recognize_google(audio)
 
-    def login_user(self, email, password):
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT * FROM users WHERE email = ? AND password = ?", (email, password))
-        return cursor.fetchone()
 
-    def update_wake_word(self, user_id, new_word):
-        cursor = self.conn.cursor()
-        cursor.execute("UPDATE users SET wake_word = ? WHERE id = ?", (new_word, user_id))
-        self.conn.commit()
+class VoskStream:
+    """One utterance fed frame by frame into a Vosk recognizer."""
 
-db = Database()
+    def __init__(self, recognizer):
+        self.recognizer = recognizer
+        self.partial = ""
+        self._final = []
 
-# --- GLOBAL STATE ---
-class AppState:
-    current_user = None 
-    is_listening = False
-    wake_word = "hey alexa"
+    def feed(self, frame):
+        """Returns the partial transcript so far."""
+        if self.recognizer.AcceptWaveform(bytes(frame)):
+            self._final.append(json.loads(self.recognizer.Result()).get("text", ""))
+            self.partial = ""
+        else:
+            self.partial = json.loads(self.recognizer.PartialResult()).get("partial", "")
+        return " ".join(t for t in self._final + [self.partial] if t)
 
-state = AppState()
+    def finish(self):
+        self._final.append(json.loads(self.recognizer.FinalResult()).get("text", ""))
+        text = " ".join(t for t in self._final if t)
+        if not text:
+            raise sr.UnknownValueError()
+        return text
 
-# --- AI & VOICE LOGIC (THREADED) ---
-def process_voice_command(command_text, page, status_control):
-    command = command_text.lower()
-    print(f"DEBUG: Processing command: {command}")
-    
-    # --- LAYER 1: WEBSITE SHORTCUTS (SMART MATCHING) ---
-    sites = {
-        "youtube": "https://www.youtube.com",
-        "google": "https://www.google.com",
-        "facebook": "https://www.facebook.com",
-        "instagram": "https://www.instagram.com",
-        "linkedin": "https://www.linkedin.com"
-    }
-    
-    for site_key, url in sites.items():
-        if site_key in command:
-            # LOGIC: Open if command contains "open" OR if the command is JUST the site name (mic cutoff)
-            if "open" in command or "launch" in command or command.strip() == site_key:
-                site_name = site_key.title()
-                update_status(page, status_control, f"Opening {site_name}...", is_active=True)
-                speak_text(f"Opening {site_name}")
-                webbrowser.open(url)
-                update_status(page, status_control, "Idle - Assistant On")
-                return
 
-    # --- LAYER 1.5: TIME & DATE ---
-    if "time" in command and "what" in command:
-        current_time = datetime.datetime.now().strftime("%I:%M %p") 
-        update_status(page, status_control, f"Time: {current_time}", is_active=True)
-        speak_text(f"The time is {current_time}")
-        update_status(page, status_control, "Idle - Assistant On")
-        return
+class VoskStt(SttBackend):
+    """Offline Kaldi recognizer on the CPU. The model is loaded once and shared."""
+    name = "vosk"
+    local = True
+    streaming = True
 
-    if "date" in command and "what" in command:
-        current_date = datetime.datetime.now().strftime("%A, %B %d, %Y")
-        update_status(page, status_control, f"Date: {current_date}", is_active=True)
-        speak_text(f"Today is {current_date}")
-        update_status(page, status_control, "Idle - Assistant On")
-        return
+    def __init__(self, model_path=VOSK_MODEL_PATH):
+        self.model_path = model_path
+        self._model = None
+        self._failed = False  # a model directory that won't load stays unavailable
+        self._lock = threading.Lock()
 
-    # --- LAYER 2: SYSTEM APPS ---
-    if "open calculator" in command:
-        update_status(page, status_control, "Opening Calculator...", is_active=True)
-        speak_text("Opening Calculator")
-        subprocess.Popen('calc.exe')
-        update_status(page, status_control, "Idle - Assistant On")
-        return
+    def available(self):
+        return (not self._failed and importlib.util.find_spec("vosk") is not None
+                and os.path.isdir(self.model_path))
 
-    if "open notepad" in command:
-        update_status(page, status_control, "Opening Notepad...", is_active=True)
-        speak_text("Opening Notepad")
-        subprocess.Popen('notepad.exe')
-        update_status(page, status_control, "Idle - Assistant On")
-        return
+    def load(self):
+        if self._failed:
+            raise sr.RequestError(f"Vosk model in {self.model_path} failed to load")
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    import vosk
+                    vosk.SetLogLevel(-1)
+                    started = time.perf_counter()
+                    try:
+                        self._model = vosk.Model(self.model_path)
+                    except Exception as e:
+                        self._failed = True
+                        raise sr.RequestError(f"Vosk model in {self.model_path} failed to load: {e}") from e
+                    print(f"DEBUG: Vosk model loaded in {time.perf_counter() - started:.1f}s")
+        return self._model
 
-    # --- LAYER 3: MUSIC PLAYER (SMART LIBRARY PRIORITY) ---
-    for song_key, song_url in music.items():
-        if song_key in command:
-            response_text = f"Playing {song_key} from Library..."
-            update_status(page, status_control, response_text, is_active=True)
-            speak_text(f"Playing {song_key}")
-            webbrowser.open(song_url)
-            time.sleep(3)
-            update_status(page, status_control, "Idle - Assistant On")
+    def open_stream(self, sample_rate=WAKE_SAMPLE_RATE):
+        import vosk
+        return VoskStream(vosk.KaldiRecognizer(self.load(), sample_rate))
+
+    def transcribe(self, audio):
+        stream = self.open_stream(audio.sample_rate)
+        stream.feed(audio.get_raw_data(convert_width=2))
+        return stream.finish()
+
+
+STT_BACKENDS = {"google": GoogleStt, "vosk": VoskStt}
+_stt_instances = {}
+_stt_lock = threading.Lock()
+
+
+def get_stt_backend(name):
+    """The shared instance of backend name (models load once per process)."""
+    with _stt_lock:
+        backend = _stt_instances.get(name)
+        if backend is None:
+            backend = _stt_instances[name] = STT_BACKENDS[name]()
+        return backend
+
+
+def stt_for(user=None):
+    """(primary, fallback) backends for user; fallback is None if there is no usable one."""
+    name = (user.stt_backend if user is not None else None) or STT_BACKEND
+    primary = get_stt_backend(name if name in STT_BACKENDS else "google")
+    if not primary.available():
+        primary = get_stt_backend("google")
+    fallback = None
+    if STT_FALLBACK in STT_BACKENDS and STT_FALLBACK != primary.name:
+        candidate = get_stt_backend(STT_FALLBACK)
+        if candidate.available():
+            fallback = candidate
+    return primary, fallback
+
+
+def transcribe(audio, primary, fallback=None):
+    """primary.transcribe(audio), retried on fallback if primary can't be reached."""
+    try:
+        return primary.transcribe(audio)
+    except sr.RequestError as e:
+        if fallback is None:
+            raise
+        print(f"DEBUG: {primary.name} STT unreachable ({e}), using {fallback.name}")
+        tracer.observe("stt.fallback", 0.0)
+        return fallback.transcribe(audio)
+
+
+def warm_stt(user=None):
+    """Loads user's (or the default) and the fallback engine, so the first command doesn't wait on a model."""
+    for backend in stt_for(user):
+        if backend is not None and backend.available():
+            backend.load()
+
+# --- SPECULATIVE DISPATCH ---
+# A streaming recognizer knows the command, more or less, before the user
+# stops talking. Partial transcripts are routed as they arrive, and a
+# question for Gemini is sent as soon as the partial holds still. When the
+# final transcript says the same, that reply is already on its way;
+# otherwise the tentative request is cancelled unread. Anything the user can
+# see or hear (speech, opening pages and apps) still waits for the final
+# transcript.
+SPECULATE = os.getenv("NEON_SPECULATE", "1") != "0"
+SPECULATE_MIN_WORDS = 3
+SPECULATE_STABLE_SECONDS = 0.15  # the partial must hold this long, i.e. a pause in speech
+SPECULATE_MAX_REQUESTS = 2       # tentative Gemini requests per command
+
+
+class Speculation:
+    """
+    Work started from the partial transcripts of one command. feed() gets
+    every partial (on the capture thread), resolve() the final transcript.
+    Used as a context manager, it cancels its request if capture fails.
+    """
+
+    def __init__(self, speculator, session, trace_id=None):
+        self.speculator = speculator
+        self.session = session
+        self.trace_id = trace_id
+        self.route = None    # (text, router match) for the latest partial
+        self.request = None  # (normalized text, reply, cancel, started, context tokens, follow-up)
+        self.requests = 0
+        self._skipped = set()  # normalized partials already decided against
+        self._partial = ""
+        self._since = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.cancel()
+        return False
+
+    def feed(self, partial):
+        partial = partial.lower().strip()
+        now = time.perf_counter()
+        if partial != self._partial:
+            self._partial, self._since = partial, now
+            self.route = (partial, router.route(partial))
+        elif now - self._since >= SPECULATE_STABLE_SECONDS:
+            self._ask(partial)
+
+    def _ask(self, command):
+        """Runs on every frame while the partial holds still, so anything decided is remembered."""
+        key = normalize_query(command)
+        if len(key.split()) < SPECULATE_MIN_WORDS or not API_KEY or key in self._skipped:
+            return
+        if (self.request is not None and self.request[0] == key) or self.requests >= SPECULATE_MAX_REQUESTS:
+            return
+        self._skipped.add(key)  # asked now or never; either way, not again
+        # Only questions that would reach Layer 4 of process_voice_command
+        if self.route[1] is not None or "play" in command or catalog.find_in_text(command):
+            return
+        user_id = self.session.current_user.id if self.session.current_user else 0
+        conversation = conversations.get(user_id)
+        context = conversation.last_question()
+        follow_up = context is not None and is_follow_up(command)
+        if response_cache.peek(user_id, command, context):
             return
+        self.cancel()
+        history, tokens = conversation.history()
+        cancel = threading.Event()
+        try:
+            reply = LLM_POOL.stream(stream_reply, command, cancel, history)
+        except Overloaded:
+            return
+        print(f"DEBUG: Speculatively asking: {command}")
+        self.requests += 1
+        self.speculator.count(requests=1)
+        self.request = (key, reply, cancel, time.perf_counter(), tokens, follow_up)
+
+    def cancel(self):
+        """Drops the tentative request, if one is still unclaimed."""
+        if self.request is not None:
+            self.request[2].set()
+            self.request = None
+            self.speculator.count(cancelled=1)
+
+    def resolve(self, command_text):
+        """
+        Checks the guesses against the final transcript. Returns (match,
+        reply): the router match if a partial read exactly the same (else
+        _NOT_ROUTED), and (reply, cancel) of the Gemini request if it asked
+        the same question (else None).
+        """
+        command = command_text.lower().strip()
+        match = _NOT_ROUTED
+        if self.route is not None:
+            self.speculator.count(commands=1)
+            if self.route[0] == command:
+                match = self.route[1]
+                self.speculator.count(route_hits=1)
+        request, self.request = self.request, None
+        if request is None:
+            return match, None
+        key, reply, cancel, started, tokens, follow_up = request
+        if key != normalize_query(command):
+            cancel.set()
+            self.speculator.count(cancelled=1)
+            return match, None
+        saved = time.perf_counter() - started
+        tracer.observe("speculation.saved", saved, self.trace_id)
+        self.speculator.count(hits=1, saved_seconds=saved)
+        conversations.record(tokens, follow_up)
+        return match, (reply, cancel)
+
+
+class Speculator:
+    """Starts a Speculation per command and counts how often it paid off."""
+
+    def __init__(self):
+        self.commands = 0
+        self.route_hits = 0
+        self.requests = 0
+        self.hits = 0
+        self.cancelled = 0
+        self.saved_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def begin(self, session, trace_id=None):
+        return Speculation(self, session, trace_id)
+
+    def count(self, **deltas):
+        with self._lock:
+            for name, delta in deltas.items():
+                setattr(self, name, getattr(self, name) + delta)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "commands": self.commands,
+                "route_hit_rate": self.route_hits / self.commands if self.commands else 0.0,
+                "requests": self.requests,
+                "hits": self.hits,
+                "cancelled": self.cancelled,
+                "hit_rate": self.hits / self.requests if self.requests else 0.0,
+                "avg_saved_ms": 1000 * self.saved_seconds / self.hits if self.hits else 0.0,
+            }
+
+
+speculator = Speculator()
+
+# --- VOICE PIPELINE (ASYNCIO) ---
+PIPELINE_QUEUE_SIZE = 4
+COMMAND_START_TIMEOUT = 7   # seconds to start talking after "Yes?"
+COMMAND_MAX_SECONDS = 10    # safety cap; commands normally end on the VAD hangover
+PIPELINE_FRAME_QUEUE_SIZE = 32  # ~1 s of 30 ms frame batches
+PIPELINE_RESTART_SECONDS = 0.5  # pause before a stage that crashed starts over
+
+
+def _put_latest(q, item):
+    """Real-time queues keep the newest item: drop the oldest one when full."""
+    if q.full():
+        try:
+            q.get_nowait()
+        except asyncio.QueueEmpty:
+            pass
+    q.put_nowait(item)
+
+
+class VoicePipeline:
+    """
+    capture -> wake -> stt -> route -> act -> speak as asyncio stages joined
+    by bounded queues. Blocking work (wake spotting, recording, transcription,
+    the command itself) runs in executor threads so the stages overlap: the
+    mic keeps listening for the wake word while a reply is being spoken.
+    A new wake word hit cancels the reply in progress (barge-in).
+    Speaking is the SpeechService queue at the end of the chain.
+    """
+
+    def __init__(self, page, status_control, capture=None, stt=None, session=None):
+        self.page = page
+        self.session = session or state
+        self.status_control = status_control
+        self.capture = capture or AudioCapture()
+        self.stt = stt  # fixed SttBackend; by default the current user's choice
+        self.spotter = WakeWordSpotter()
+        self.active = None
+        self.active_cancel = None
+        self._wake_executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="wake")
+        # The cloud wake check sleeps from a hit until the command is captured,
+        # or the command audio would be sent off twice
+        self._cloud_wake_paused = False
+        self._cloud_wake_from = 0
+
+    def status(self, text, is_active=False):
+        update_status(self.page, self.status_control, text, is_active)
+
+    def stt_backends(self):
+        if self.stt is not None:
+            return self.stt, None
+        return stt_for(self.session.current_user)
 
-    if "play" in command:
-        song = command.replace("play", "").strip()
-        if song: 
-            response_text = f"Playing {song} on YouTube..."
-            update_status(page, status_control, response_text, is_active=True)
-            speak_text(f"Playing {song}")
-            webbrowser.open(f"https://www.youtube.com/results?search_query={song}")
-            time.sleep(3) 
-            update_status(page, status_control, "Idle - Assistant On")
+    async def speak(self, text, priority=PRIORITY_NORMAL):
+        utt = speech.say(text, priority)
+        await asyncio.get_running_loop().run_in_executor(None, utt.wait)
+        return utt
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.frames_q = asyncio.Queue(PIPELINE_FRAME_QUEUE_SIZE)
+        self.wake_q = asyncio.Queue(PIPELINE_QUEUE_SIZE)
+        self.command_q = asyncio.Queue(PIPELINE_QUEUE_SIZE)
+        self.action_q = asyncio.Queue(PIPELINE_QUEUE_SIZE)
+
+        # Open the Mic Once and keep it open
+        self.capture.start()
+        # Normally already done since the login screen; blocks only on a cold start
+        warming = loop.run_in_executor(None, warm_up)
+        print("DEBUG: Adjusting for background noise...")
+        try:
+            has_audio = await loop.run_in_executor(None, prime_noise_floor, self.capture)
+        except OSError:
+            has_audio = False
+        await warming
+        if self.capture.error is not None or not has_audio:
+            print("CRITICAL ERROR: No Microphone found! Check Windows Settings.")
             return
 
-    # --- LAYER 4: AI INTELLIGENCE ---
-    try:
-        update_status(page, status_control, "Thinking...", is_active=True)
-        
-        if API_KEY:
-            selected_model = "gemini-2.5-flash" 
-            
-            system_role = (
-                "You are a helpful, friendly, and concise AI assistant. "
-                "You are speaking to the user through voice. Keep your responses brief and conversational. "
-                "Do NOT use asterisks, markdown formatting, or special characters in your response. "
-                "Speak naturally as if having a voice conversation."
-            )
-            
-            model = genai.GenerativeModel(selected_model, system_instruction=system_role)
-            
-            response = model.generate_content(command)
-            ai_reply = response.text
-            
-            clean_reply = ai_reply.replace("*", "").replace("#", "")
-        else:
-            ai_reply = "API Key missing."
-            clean_reply = "I cannot find my API key."
-        
-        update_status(page, status_control, clean_reply, is_active=True)
-        speak_text(clean_reply)
-    
-    except Exception as e:
-        print(f"AI Error: {e}")
-        error_msg = "I'm having trouble connecting to the server."
-        update_status(page, status_control, error_msg)
-        speak_text(error_msg)
+        tasks = [asyncio.create_task(self._supervise(stage)) for stage in (
+            self.capture_stage, self.wake_stage, self.stt_stage, self.route_stage, self.act_stage)]
+        # Only the capture stage ever returns: the microphone went away
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in pending:
+            task.cancel()
+        self.barge_in()
+        self._wake_executor.shutdown(wait=False)
+        self.status("Microphone lost. Assistant off.")
+        if self.session.pipeline is self:
+            # The next dashboard build starts a fresh pipeline
+            self.session.pipeline = None
+        for task in done:
+            task.result()
 
-def update_status(page, control, text, is_active=False):
-    control.value = text
-    control.color = "cyanAccent" if is_active else "grey400"
-    page.update()
-
-# --- REVISED LISTENER FUNCTION ---
-def start_background_listener(page, status_control):
-    recognizer = sr.Recognizer()
-    recognizer.dynamic_energy_threshold = False 
-    recognizer.energy_threshold = 400 
-    
-    # Initialize Mic Once
-    try:
-        with sr.Microphone() as source:
-            print("DEBUG: Adjusting for background noise...")
-            recognizer.adjust_for_ambient_noise(source, duration=1)
-    except OSError:
-        print("CRITICAL ERROR: No Microphone found! Check Windows Settings.")
-        return
+    async def _supervise(self, stage):
+        """Runs a stage, restarting it after an unexpected error instead of ending the assistant."""
+        while True:
+            try:
+                return await stage()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"General Loop Error in {stage.__name__}: {e}")
+                self.resume_cloud_wake()
+                self.status("Idle - Assistant On")
+                await asyncio.sleep(PIPELINE_RESTART_SECONDS)
 
-    while True:
-        if not state.is_listening:
-            time.sleep(1)
-            continue
-            
+    # --- stages ---
+    async def capture_stage(self):
+        """Hands new ring buffer frames downstream as (start, end) index ranges, no copies."""
+        ring = self.capture.ring
+        cursor = ring.write_index
+        while self.capture.running:
+            await asyncio.sleep(self.capture.frame_seconds)
+            end = ring.write_index
+            if end != cursor and self.session.is_listening:
+                _put_latest(self.frames_q, (cursor, end))
+            cursor = end
+        print("DEBUG: Microphone stream ended.")
+
+    async def wake_stage(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start, end = await self.frames_q.get()
+            if not self.session.is_listening:
+                continue
+
+            if self.spotter.set_keyphrase(self.session.wake_word):
+                hit = await loop.run_in_executor(self._wake_executor, self._spot, start, end)
+                if hit is None:
+                    continue
+                trace_id = tracer.new_interaction()
+                tracer.observe("wake", self.spotter.latencies[-1], trace_id)
+                print(f"DEBUG: Local spotter hit in {self.spotter.latencies[-1] * 1000:.0f} ms "
+                      f"(CPU load {self.spotter.cpu_load:.1%})")
+            else:
+                if self._cloud_wake_paused or end <= self._cloud_wake_from:
+                    continue
+                cloud_start = time.perf_counter()
+                hit = await self._cloud_wake(max(start, self._cloud_wake_from))
+                if hit is None:
+                    continue
+                trace_id = tracer.new_interaction()
+                tracer.observe("wake.cloud", time.perf_counter() - cloud_start, trace_id)
+
+            print(f"DEBUG: Wake word '{self.session.wake_word}' detected!")
+            self._cloud_wake_paused = True
+            if SPECULATE:
+                prewarm_llm()
+            self.barge_in()
+            _put_latest(self.wake_q, (hit, trace_id, time.perf_counter_ns()))
+
+    def _spot(self, start, end):
+        for index in range(max(start, self.capture.ring.oldest_index), end):
+            frame = self.capture.ring.frame(index)
+            if frame is not None and self.spotter.process(frame):
+                return index + 1
+        return None
+
+    async def _cloud_wake(self, start):
+        """Fallback when the local spotter can't handle the wake word: ask Google."""
+        loop = asyncio.get_running_loop()
         try:
-            with sr.Microphone() as mic:
-                print("DEBUG: Waiting for wake word...")
-                
+            audio = await loop.run_in_executor(
+                None, lambda: capture_utterance(self.capture, start, timeout=2, phrase_time_limit=4))
+            text = (await asyncio.wrap_future(STT_POOL.submit(transcribe, audio, *self.stt_backends()))).lower()
+        except (sr.WaitTimeoutError, sr.UnknownValueError, Overloaded):
+            return None
+        except sr.RequestError as e:
+            print(f"DEBUG: Speech service unreachable while listening for the wake word: {e}")
+            return None
+        except Exception as e:
+            print(f"General Loop Error: {e}")
+            return None
+        finally:
+            # That audio has been consumed already
+            while not self.frames_q.empty():
+                self.frames_q.get_nowait()
+        return self.capture.ring.write_index if self.session.wake_word.lower() in text else None
+
+    async def stt_stage(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            hit, trace_id, woke_ns = await self.wake_q.get()
+            self.status("Listening for command...", is_active=True)
+            prompt = await self.speak("Yes?", PRIORITY_HIGH)
+
+            # Anything said right before "Yes?" is still in the buffer. The
+            # mic also heard "Yes?" itself, so that stretch can't start the command.
+            pre_roll = self.capture.seconds_to_frames(PRE_ROLL_SECONDS)
+            command_start = max(hit, self.capture.ring.write_index - pre_roll)
+            echo = None
+            if prompt.first_audio_at is not None:
+                echo = (int(prompt.first_audio_at * 1e9), time.perf_counter_ns() + int(ECHO_TAIL_SECONDS * 1e9))
+            print("DEBUG: Listening for command NOW (Mic active)...")
+
+            vad = Endpointer(self.capture.noise, self.capture.frame_seconds)
+            try:
                 try:
-                    audio = recognizer.listen(mic, timeout=2, phrase_time_limit=4)
-                    text = recognizer.recognize_google(audio).lower()
-                except sr.WaitTimeoutError:
-                    continue 
-                except sr.UnknownValueError:
-                    continue 
-                
-                # --- WAKE WORD DETECTED ---
-                if state.wake_word.lower() in text:
-                    print(f"DEBUG: Wake word '{text}' detected!")
-                    update_status(page, status_control, "Listening for command...", is_active=True)
-                    
-                    speak_text("Yes?") 
-                    
-                    print("DEBUG: Listening for command NOW (Mic active)...")
-                    
-                    try:
-                        audio_cmd = recognizer.listen(mic, timeout=7, phrase_time_limit=10)
-                        command_text = recognizer.recognize_google(audio_cmd).lower()
-                        
-                        print(f"DEBUG: I heard command -> {command_text}")
-                        speak_text("On it.")
-                        
-                        process_voice_command(command_text, page, status_control)
-                        
-                    except sr.WaitTimeoutError:
-                        print("DEBUG: Command timeout.")
-                        update_status(page, status_control, "Timed out. Idle.")
-                        speak_text("I didn't hear anything.")
-                        
-                    except sr.UnknownValueError:
-                        print("DEBUG: Command unintelligible.")
-                        update_status(page, status_control, "Didn't understand. Idle.")
-                        speak_text("I couldn't understand that.")
-
-                    # Final Reset
-                    update_status(page, status_control, "Idle - Assistant On")
+                    primary, fallback, stream = self.open_stt()
+                    spec = speculator.begin(self.session, trace_id)
+                    shown = [""]
+
+                    def show_partial(frame):
+                        partial = stream.feed(frame)
+                        if partial and partial != shown[0]:
+                            shown[0] = partial
+                            self.status(f"Heard: {partial}...", is_active=True)
+                        if partial and SPECULATE:
+                            spec.feed(partial)
+
+                    on_frame = show_partial if stream is not None else None
+                    with spec, tracer.stage("stt.capture", trace_id):
+                        audio_cmd = await loop.run_in_executor(
+                            None, lambda: capture_utterance(self.capture, command_start, COMMAND_START_TIMEOUT,
+                                                            COMMAND_MAX_SECONDS, on_frame=on_frame, endpointer=vad,
+                                                            echo=echo))
+                finally:
+                    self.resume_cloud_wake()
+                with spec, tracer.stage("stt.recognize", trace_id):
+                    if stream is not None:
+                        # Already decoded while the user was talking
+                        command_text = (await loop.run_in_executor(None, stream.finish)).lower()
+                    else:
+                        command_text = (await asyncio.wrap_future(
+                            STT_POOL.submit(transcribe, audio_cmd, primary, fallback))).lower()
+                # From the last voiced frame leaving the mic to having the text
+                tracer.record("stt.eos_to_transcript", self.capture.arrival_ns(vad.last_voiced),
+                              time.perf_counter_ns(), trace_id)
+            except sr.WaitTimeoutError:
+                print("DEBUG: Command timeout.")
+                self.status("Timed out. Idle.")
+                await self.speak("I didn't hear anything.")
+                self.status("Idle - Assistant On")
+                continue
+            except sr.UnknownValueError:
+                print("DEBUG: Command unintelligible.")
+                self.status("Didn't understand. Idle.")
+                await self.speak("I couldn't understand that.")
+                self.status("Idle - Assistant On")
+                continue
+            except Overloaded as e:
+                print(f"DEBUG: Busy, turning a request away ({e})")
+                self.status("Busy. Idle.")
+                await self.speak("I'm handling a lot of requests right now. Please try again in a moment.")
+                self.status("Idle - Assistant On")
+                continue
+            except sr.RequestError as e:
+                print(f"DEBUG: Speech service unreachable: {e}")
+                self.status("Speech service offline. Idle.")
+                await self.speak("I can't reach the speech service right now.")
+                self.status("Idle - Assistant On")
+                continue
+            except Exception as e:
+                print(f"General Loop Error: {e}")
+                self.status("Idle - Assistant On")
+                continue
+
+            print(f"DEBUG: I heard command -> {command_text}")
+            await self.command_q.put((command_text, spec, trace_id, woke_ns))
+
+    def open_stt(self):
+        """
+        (primary, fallback, stream) for the next command. stream is None when
+        the command is recorded first and transcribed after, which is also
+        what happens if the streaming recognizer fails to start.
+        """
+        primary, fallback = self.stt_backends()
+        if not primary.streaming:
+            return primary, fallback, None
+        try:
+            return primary, fallback, primary.open_stream(self.capture.sample_rate)
+        except Exception as e:
+            print(f"DEBUG: {primary.name} STT stream failed to open ({e}), transcribing after the command instead")
+            primary, fallback = self.stt_backends()
+            if not primary.available() and fallback is not None:
+                primary, fallback = fallback, None
+            return primary, fallback, None
 
+    def resume_cloud_wake(self):
+        """Lets the cloud wake check run again, on audio after the command only."""
+        self._cloud_wake_paused = False
+        self._cloud_wake_from = self.capture.ring.write_index
+
+    async def route_stage(self):
+        while True:
+            command_text, spec, trace_id, woke_ns = await self.command_q.get()
+            # The last partial may have been routed already, and the reply requested
+            match, reply = spec.resolve(command_text)
+            if match is _NOT_ROUTED:
+                with tracer.stage("route", trace_id):
+                    match = router.route(command_text)
+            await self.action_q.put((command_text, match, reply, trace_id, woke_ns))
+
+    async def act_stage(self):
+        while True:
+            command_text, match, reply, trace_id, woke_ns = await self.action_q.get()
+            # A newer command always wins over an older reply
+            self.barge_in()
+            reply, cancel = reply or (None, threading.Event())
+            self.active_cancel = cancel
+            self.active = asyncio.create_task(
+                self._interaction(command_text, match, reply, cancel, trace_id, woke_ns))
+
+    async def _interaction(self, command_text, match, reply, cancel, trace_id, woke_ns):
+        loop = asyncio.get_running_loop()
+        speech.say("On it.", trace_id=trace_id)
+        try:
+            with tracer.stage("act", trace_id):
+                await loop.run_in_executor(
+                    None, process_voice_command, command_text, self.page, self.status_control, match, cancel, trace_id,
+                    self.session, reply)
+        except asyncio.CancelledError:
+            cancel.set()
+            raise
         except Exception as e:
             print(f"General Loop Error: {e}")
-            time.sleep(1)
+        if not cancel.is_set():
+            tracer.record("interaction", woke_ns, time.perf_counter_ns(), trace_id)
+            self.status("Idle - Assistant On")
+
+    def barge_in(self):
+        """Stops the reply in flight: generation, queued speech and playback."""
+        if self.active is not None and not self.active.done():
+            print("DEBUG: Barge-in, cancelling current reply.")
+            self.active_cancel.set()
+            self.active.cancel()
+        speech.cancel_all()
+
+
+def start_background_listener(page, status_control, capture=None, session=None):
+    """Thread target: runs the voice pipeline on its own event loop."""
+    asyncio.run(VoicePipeline(page, status_control, capture, session=session).run())
+
+# --- STARTUP WARM-UP ---
+WARM_UP_TTS_TIMEOUT = 10.0
+warmed_up = threading.Event()
+_warm_up_lock = threading.Lock()
+
+
+def warm_up():
+    """
+    Loads everything the first voice command needs: the database, music
+    catalog, recognizer, TTS engine, KWS decoder and Gemini model. Each step
+    is traced as startup.warm.<name>; a failing step is logged and skipped.
+    """
+    with _warm_up_lock:
+        if warmed_up.is_set():
+            return
+        steps = [
+            ("db", db.connection),
+            ("catalog", catalog.sync_music_library),
+            ("speech_recognition", sr.load),
+            ("stt", warm_stt),
+            ("tts", warm_tts),
+            ("pocketsphinx", load_sphinx),
+            ("gemini", lambda: API_KEY and get_llm_model()),
+        ]
+        for name, step in steps:
+            try:
+                with tracer.stage(f"startup.warm.{name}"):
+                    step()
+            except Exception as e:
+                print(f"DEBUG: Warm-up step {name} failed: {e}")
+        warmed_up.set()
+        print("DEBUG: Warm-up complete.")
+
+
+def warm_tts():
+    if SERVER_MODE:
+        # Browser sessions get rendered clips; the server's own speaker stays unused
+        TTS_POOL.run(synthesize_wav, FIXED_PHRASES[0])
+    else:
+        speech.start()._ready.wait(WARM_UP_TTS_TIMEOUT)
+
+
+def start_warm_up():
+    """Runs warm_up() on a daemon thread so the window stays responsive."""
+    if not warmed_up.is_set():
+        threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+
+
+# --- BATCH MODE (HEADLESS) ---
+# Text commands from a JSONL file go through process_voice_command without a
+# window, mic or speaker: speech and side effects are recorded instead of
+# performed. Each command gets one result line, for regression runs over the
+# router and throughput runs over the Gemini fallback. Answer cache and
+# conversation memory live in a scratch database for the run, and every
+# command is its own conversation, so results don't depend on earlier runs
+# or on which worker got there first.
+class BatchRecorder:
+    """Speaker and action executor for one batch command; records instead of doing."""
+
+    def __init__(self):
+        self.said = []
+        self.actions = []
+
+    def say(self, text, priority=PRIORITY_NORMAL, trace_id=None):
+        self.said.append(text)
+        utt = Utterance(text, priority, trace_id)
+        utt.done.set()
+        return utt
+
+    def run(self, kind, payload, on_done=None, trace_id=None):
+        if kind not in ACTIONS:
+            raise KeyError(kind)
+        self.actions.append((kind, payload))
+        future = concurrent.futures.Future()
+        future.set_result(payload)
+        if on_done is not None:
+            on_done(future)
+        return future
+
+
+def read_batch(path):
+    """
+    Batch items from a JSONL file: {"command": ..., "id": ..., "expect": ...}
+    or a bare string per line. Returns (items, skipped); lines that aren't a
+    valid item are reported with their line number and skipped.
+    """
+    items, skipped = [], 0
+    with open(path, encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+            except ValueError as e:
+                item, problem = None, f"not valid JSON ({e})"
+            else:
+                if isinstance(item, str):
+                    item = {"command": item}
+                if not isinstance(item, dict):
+                    problem = "expected a JSON object or string"
+                elif not isinstance(item.get("command"), str) or not item["command"].strip():
+                    problem = 'missing a "command" string'
+                else:
+                    problem = None
+            if problem:
+                print(f"{path}:{number}: skipped, {problem}")
+                skipped += 1
+                continue
+            item.setdefault("id", number)
+            item["index"] = len(items) + 1
+            items.append(item)
+    return items, skipped
+
+
+def run_batch_command(item):
+    """Runs one batch item and returns its result line as a dict."""
+    recorder = BatchRecorder()
+    session = AppState()
+    session.speaker = session.actions = recorder
+    # Own id, own conversation and cache entries (in the scratch database)
+    session.current_user = User(-item["index"])
+    command = item.get("command", "")
+    trace_id = tracer.new_interaction()
+    started = time.perf_counter()
+    match = None
+    try:
+        with tracer.stage("route", trace_id):
+            match = router.route(command)
+        handled = process_voice_command(command, None, None, match, trace_id=trace_id, session=session)
+        error = None
+    except Exception as e:
+        handled, error = "exception", str(e)
+    intent, intent_key = (match.kind, match.intent.key) if match else (None, None)
+    if match is None and handled == "song":
+        # Library titles are found by the catalog rather than the router
+        found = catalog.find_in_text(command)
+        if found is None:
+            best = catalog.search(command.lower().replace("play", "").strip(), limit=1)
+            found = best[0][1:] if best else (None, None)
+        intent, intent_key = "song", found[0]
+    result = {
+        "id": item["id"],
+        "command": command,
+        "intent": intent,
+        "intent_key": intent_key,
+        "action": handled,
+        "effects": [{"kind": kind, "target": target} for kind, target in recorder.actions],
+        "reply": " ".join(recorder.said),
+        "latency_ms": round((time.perf_counter() - started) * 1000, 3),
+    }
+    if error is not None:
+        result["error"] = error
+    # expect can name either the intent ("site") or the action ("llm")
+    if "expect" in item:
+        result["ok"] = item["expect"] in (result["intent"], result["action"])
+    return result
+
+
+def run_batch(path, workers=1, out_path=None):
+    """
+    Runs every command in the JSONL file at path, on workers threads, and
+    writes the result lines in input order to out_path (next to the input
+    by default). Prints a summary and returns the results.
+    """
+    global response_cache, conversations, catalog
+    items, skipped = read_batch(path)
+    out_path = out_path or os.path.splitext(path)[0] + ".results.jsonl"
+    saved = response_cache, conversations, catalog
+    with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as tmp:
+        # Everything the commands read or write lives here, never in user_data.db
+        scratch = Database(os.path.join(tmp, "batch.db"))
+        response_cache, conversations = ResponseCache(scratch), ConversationStore(scratch)
+        catalog = MusicCatalog(scratch)
+        try:
+            catalog.sync_music_library()
+            started = time.perf_counter()
+            if workers > 1:
+                with concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix="batch") as pool:
+                    results = list(pool.map(run_batch_command, items))
+            else:
+                results = [run_batch_command(item) for item in items]
+            elapsed = time.perf_counter() - started
+        finally:
+            response_cache, conversations, catalog = saved
+            scratch.close()
+
+    with open(out_path, "w", encoding="utf-8") as f:
+        for result in results:
+            f.write(json.dumps(result) + "\n")
+
+    print(f"Ran {len(results)} commands in {elapsed:.2f}s ({len(results) / elapsed if elapsed else 0:.1f}/s) "
+          f"on {workers} worker(s); results in {out_path}")
+    if skipped:
+        print(f"Skipped {skipped} invalid line(s)")
+    if results:
+        p = _percentiles([r["latency_ms"] for r in results])
+        print(f"Latency: p50 {p['p50']:.2f} ms, p95 {p['p95']:.2f} ms, p99 {p['p99']:.2f} ms, max {p['max']:.2f} ms")
+    counts = Counter(r["action"] for r in results)
+    print("Actions: " + ", ".join(f"{action} {n}" for action, n in counts.most_common()))
+    checked = [r for r in results if "ok" in r]
+    failed = [r for r in checked if not r["ok"]]
+    if checked:
+        print(f"Expectations: {len(checked) - len(failed)}/{len(checked)} met")
+        for r in failed:
+            print(f"  #{r['id']} {r['command']!r}: got intent {r['intent']}, action {r['action']}")
+    return results
+
 
 # --- UI APPLICATION ---
-def main(page: ft.Page):
+ASSETS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "assets")
+
+# Fonts ship with the app (assets/fonts) so startup never waits on the network.
+# A missing file just falls back to the platform default font.
+FONT_FILES = {
+    "Roboto": "fonts/Roboto-Regular.ttf",
+    "Roboto Bold": "fonts/Roboto-Bold.ttf",
+}
+
+# Views that show something about the logged-in user
+USER_ROUTES = ("/setup", "/dashboard")
+
+
+def local_fonts():
+    return {name: path for name, path in FONT_FILES.items() if os.path.exists(os.path.join(ASSETS_DIR, path))}
+
+
+def main(page: "ft.Page"):
+    started = time.perf_counter()
     page.title = "Neon AI Assistant"
     page.theme_mode = ft.ThemeMode.DARK
     page.window_width = 450
     page.window_height = 800
     page.padding = 0
     
-    page.fonts = {"Roboto": "https://fonts.googleapis.com/css2?family=Roboto:wght@400;700&display=swap"}
-    page.theme = ft.Theme(font_family="Roboto", color_scheme_seed="cyan")
+    page.fonts = local_fonts()
+    page.theme = ft.Theme(font_family="Roboto" if "Roboto" in page.fonts else None, color_scheme_seed="cyan")
+    # Flet maps one file per family, so bold text asks for the bold face by name
+    bold_font = "Roboto Bold" if "Roboto Bold" in page.fonts else None
+
+    # --- SESSION ---
+    if SERVER_MODE:
+        try:
+            session = sessions.open(page.session_id)
+        except Overloaded as e:
+            print(f"DEBUG: Turning a session away ({e})")
+            page.add(ft.Text("The assistant is at capacity right now. Please try again in a few minutes.", size=18))
+            return
+        session.page = page
+        session.speaker = WebSpeaker(page)
+        page.on_close = lambda e: sessions.close(page.session_id)
+    else:
+        session = state
+
+    # --- VIEW CACHE ---
+    # Each route's control tree is built once and reused on later visits.
+    view_cache = {}
+
+    def invalidate_views(*routes):
+        for route in routes or list(view_cache):
+            view_cache.pop(route, None)
+
+    def set_current_user(user):
+        """The only place current_user changes; drops the views built for the previous user."""
+        session.current_user = user
+        session.wake_word = user.wake_word if user else "hey alexa"
+        invalidate_views(*USER_ROUTES)
+        if user is not None:
+            # The user's speech engine may not be the one warmed up at startup
+            threading.Thread(target=warm_stt, args=(user,), name="warm-stt", daemon=True).start()
 
     # --- HELPER UI ---
     def get_gradient_container(content):
@@ -323,9 +3840,9 @@ def main(page: ft.Page):
         def handle_login(e):
             user = db.login_user(email_field.value, pass_field.value)
             if user:
-                state.current_user = user
-                state.wake_word = user[8] 
-                if state.wake_word == "hey alexa":
+                set_current_user(user)
+                pass_field.value = ""
+                if session.wake_word == "hey alexa":
                     page.go("/setup")
                 else:
                     page.go("/dashboard")
@@ -335,7 +3852,7 @@ def main(page: ft.Page):
         return get_gradient_container(
             ft.Column([
                 ft.Icon(name="auto_awesome", size=80, color="cyanAccent"),
-                ft.Text("AI ASSISTANT", size=30, weight="bold", color="cyanAccent"),
+                ft.Text("AI ASSISTANT", size=30, weight="bold", font_family=bold_font, color="cyanAccent"),
                 ft.Divider(height=50, color="transparent"),
                 email_field,
                 pass_field,
@@ -381,13 +3898,14 @@ def main(page: ft.Page):
             success = db.register_user(email.value, password.value, f_name.value, l_name.value, int(age.value), role, place)
             if success:
                 page.open(ft.SnackBar(ft.Text("Account Created! Please Login."), bgcolor="green"))
+                invalidate_views("/register")
                 page.go("/")
             else:
                 page.open(ft.SnackBar(ft.Text("Email already exists."), bgcolor="red"))
 
         return get_gradient_container(
             ft.ListView([
-                ft.Text("Create Account", size=30, weight="bold"),
+                ft.Text("Create Account", size=30, weight="bold", font_family=bold_font),
                 ft.Row([f_name, l_name]),
                 age,
                 email,
@@ -405,104 +3923,198 @@ def main(page: ft.Page):
     # --- SCREEN 3: SETUP ---
     def setup_screen():
         wake_word_input = ft.TextField(label="Wake Word", value="Hey Alexa")
+        current_stt = (session.current_user.stt_backend if session.current_user else None) or STT_BACKEND
+        stt_input = ft.Dropdown(label="Speech Recognition", value=current_stt, options=[
+            ft.dropdown.Option("google", "Google (online)"),
+            ft.dropdown.Option("vosk", "Vosk (offline, on this computer)"),
+        ])
         
         def save_setup(e):
-            if state.current_user:
-                db.update_wake_word(state.current_user[0], wake_word_input.value)
-                state.wake_word = wake_word_input.value
+            if session.current_user:
+                db.update_wake_word(session.current_user.id, wake_word_input.value)
+                db.update_stt_backend(session.current_user.id, stt_input.value)
+                session.current_user.wake_word = wake_word_input.value
+                session.current_user.stt_backend = stt_input.value
+                session.wake_word = wake_word_input.value
+                threading.Thread(target=warm_stt, args=(session.current_user,), name="warm-stt", daemon=True).start()
                 page.go("/dashboard")
 
         return get_gradient_container(
             ft.Column([
-                ft.Text("Setup Assistant", size=24, weight="bold"),
+                ft.Text("Setup Assistant", size=24, weight="bold", font_family=bold_font),
                 wake_word_input,
+                stt_input,
                 ft.ElevatedButton("Complete Setup", on_click=save_setup)
             ], alignment=ft.MainAxisAlignment.CENTER)
         )
 
     # --- SCREEN 4: DASHBOARD ---
     def dashboard_screen():
-        user_name = state.current_user[3] if state.current_user else "User"
+        user_name = session.current_user.first_name if session.current_user else "User"
         status_text = ft.Text("Idle - Assistant Off", size=16, color="grey400", text_align=ft.TextAlign.CENTER)
         
         def show_profile(e):
-            u = state.current_user
+            u = session.current_user
             if not u: return
             
             dlg = ft.AlertDialog(
                 title=ft.Text("User Profile"),
                 content=ft.Column([
-                    ft.Text(f"Name: {u[3]} {u[4]}"),
-                    ft.Text(f"Age: {u[5]}"),
-                    ft.Text(f"Role: {u[6]}"),
-                    ft.Text(f"Organization: {u[7]}"),
+                    ft.Text(f"Name: {u.first_name} {u.last_name}"),
+                    ft.Text(f"Age: {u.age}"),
+                    ft.Text(f"Role: {u.occupation_type}"),
+                    ft.Text(f"Organization: {u.institution_or_company}"),
                     ft.Divider(),
-                    ft.Text(f"Wake Word: {state.wake_word}", weight="bold", color="cyan")
-                ], height=200, tight=True),
+                    ft.Text(f"Wake Word: {session.wake_word}", weight="bold", font_family=bold_font, color="cyan"),
+                    ft.Text(cache_summary(), size=12, color="grey400"),
+                    ft.Text(context_summary(), size=12, color="grey400")
+                ], height=260, tight=True),
             )
             page.open(dlg)
 
         def toggle_listening(e):
-            state.is_listening = e.control.value
-            status_text.value = f"Listening for '{state.wake_word}'..." if state.is_listening else "Idle - Assistant Off"
-            status_text.color = "cyan" if state.is_listening else "grey400"
-            page.update()
+            session.is_listening = e.control.value
+            ui_for(page).set(
+                status_text,
+                value=f"Listening for '{session.wake_word}'..." if session.is_listening else "Idle - Assistant Off",
+                color="cyan" if session.is_listening else "grey400")
 
         def clear_status(e):
-            status_text.value = "Idle"
-            status_text.color = "grey400"
-            page.update()
+            ui_for(page).set(status_text, value="Idle", color="grey400")
+
+        # Web sessions have no microphone on their side of the server: they type
+        command_field = ft.TextField(hint_text="Type a command, e.g. what time is it", expand=True,
+                                     border_radius=20, on_submit=lambda e: send_command(e))
+
+        def send_command(e):
+            text = (command_field.value or "").strip()
+            if not text:
+                return
+            command_field.value = ""
+            ui_for(page).set(status_text, value=f"You: {text}", color="cyanAccent")
+            try:
+                submit_command(session, text, page, status_text)
+            except Overloaded:
+                ui_for(page).set(status_text, value="Busy right now, please try again in a moment.", color="grey400")
+            page.update(command_field)
+
+        # --- PERFORMANCE PANEL ---
+        perf_rows = ft.Column([ft.Text("No interactions yet.", size=12, color="grey400")], spacing=2)
+        perf_open = {"value": False}
+
+        def refresh_perf():
+            stats = tracer.snapshot()
+            if not stats:
+                return
+            rows = [ft.Text(f"{'stage':<20}{'n':>5}{'p50':>7}{'p95':>7}{'p99':>7} ms", size=11, weight="bold", font_family="monospace")]
+            for stage, s in stats.items():
+                rows.append(ft.Text(
+                    f"{stage:<20}{s['count']:>5}{s['p50'] * 1000:>7.0f}{s['p95'] * 1000:>7.0f}{s['p99'] * 1000:>7.0f}",
+                    size=11, font_family="monospace", color="grey400"))
+            ui_for(page).set(perf_rows, controls=rows)
+
+        def toggle_perf(e):
+            perf_open["value"] = e.data == "true"
+            if perf_open["value"]:
+                refresh_perf()
 
-        if not hasattr(state, 'thread_started'):
-            t = threading.Thread(target=start_background_listener, args=(page, status_text), daemon=True)
-            t.start()
-            state.thread_started = True
+        def perf_loop(gen):
+            # Ends when this dashboard is rebuilt for another user
+            while session.perf_panel_gen == gen:
+                if perf_open["value"] and page.route == "/dashboard":
+                    refresh_perf()
+                time.sleep(1)
+
+        def export_trace(e):
+            path = f"trace_{time.strftime('%Y%m%d_%H%M%S')}.json"
+            count = tracer.export_chrome_trace(path)
+            page.open(ft.SnackBar(ft.Text(f"Saved {count} spans to {path}"), bgcolor="green"))
+
+        session.perf_panel_gen += 1
+        threading.Thread(target=perf_loop, args=(session.perf_panel_gen,), daemon=True).start()
+
+        tracer.start_rollup(db)
+        if session.web:
+            status_text.value = "Idle - Assistant On"
+            assistant_control = ft.Row([
+                command_field,
+                ft.IconButton(icon="send", icon_color="cyanAccent", on_click=send_command),
+            ])
+        else:
+            assistant_control = ft.Switch(label="Activate Assistant", value=session.is_listening,
+                                          on_change=toggle_listening, active_color="cyanAccent")
+            if session.pipeline is None:
+                session.pipeline = VoicePipeline(page, status_text, session=session)
+                t = threading.Thread(target=lambda: asyncio.run(session.pipeline.run()), daemon=True)
+                t.start()
+            else:
+                # Rebuilt dashboard: point the running assistant at the new status text
+                session.pipeline.status_control = status_text
 
         return get_gradient_container(
             ft.Column([
                 ft.Row([
-                    ft.Text("AI ASSISTANT", weight="bold", size=20, color="cyanAccent"),
+                    ft.Text("AI ASSISTANT", weight="bold", font_family=bold_font, size=20, color="cyanAccent"),
                     ft.IconButton(icon="person", on_click=show_profile, bgcolor="#424242")
                 ], alignment=ft.MainAxisAlignment.SPACE_BETWEEN),
                 
                 ft.Divider(color="transparent"),
                 
                 ft.Column([
-                    ft.Text(f"Welcome, {user_name}", size=30, weight="bold"),
+                    ft.Text(f"Welcome, {user_name}", size=30, weight="bold", font_family=bold_font),
                     ft.Container(height=20),
                     ft.Container(
-                        content=ft.Switch(label="Activate Assistant", value=state.is_listening, on_change=toggle_listening, active_color="cyanAccent"),
+                        content=assistant_control,
                         padding=20, border=ft.border.all(1, "#424242"), border_radius=20, bgcolor="#000000"
                     ),
                     ft.Container(height=30),
                     ft.Container(
                         content=ft.Column([
-                            ft.Row([ft.Text("Current Response", weight="bold"), ft.IconButton(icon="close", icon_color="red", icon_size=20, on_click=clear_status)], alignment=ft.MainAxisAlignment.SPACE_BETWEEN),
+                            ft.Row([ft.Text("Current Response", weight="bold", font_family=bold_font), ft.IconButton(icon="close", icon_color="red", icon_size=20, on_click=clear_status)], alignment=ft.MainAxisAlignment.SPACE_BETWEEN),
                             ft.Divider(),
                             status_text
                         ]),
                         padding=20, bgcolor="#212121", border_radius=15, expand=True 
+                    ),
+                    ft.ExpansionTile(
+                        title=ft.Text("Performance", weight="bold", font_family=bold_font),
+                        subtitle=ft.Text("Latency per stage, live", size=12, color="grey400"),
+                        on_change=toggle_perf,
+                        controls=[
+                            perf_rows,
+                            ft.TextButton("Export trace (Chrome JSON)", icon="download", on_click=export_trace)
+                        ],
+                        bgcolor="#212121", collapsed_bgcolor="#212121"
                     )
                 ], horizontal_alignment=ft.CrossAxisAlignment.CENTER, expand=True)
             ])
         )
 
     # --- ROUTING (FIXED BLACK BACKGROUND) ---
+    screens = {
+        "/": login_screen,
+        "/register": register_screen,
+        "/setup": setup_screen,
+        "/dashboard": dashboard_screen,
+    }
+
     def route_change(e):
-        page.views.clear()
+        route_start = time.perf_counter_ns()
         troute = page.route if page.route else "/"
+        if troute not in screens:
+            return
         
-        # We apply padding=0 and bgcolor="#000000" to ALL views to prevent the white glitch
-        if troute == "/": 
-            page.views.append(ft.View("/", [login_screen()], padding=0, bgcolor="#000000"))
-        elif troute == "/register": 
-            page.views.append(ft.View("/register", [register_screen()], padding=0, bgcolor="#000000"))
-        elif troute == "/setup": 
-            page.views.append(ft.View("/setup", [setup_screen()], padding=0, bgcolor="#000000"))
-        elif troute == "/dashboard": 
-            page.views.append(ft.View("/dashboard", [dashboard_screen()], padding=0, bgcolor="#000000"))
-            
+        view = view_cache.get(troute)
+        cached = view is not None
+        if view is None:
+            # We apply padding=0 and bgcolor="#000000" to ALL views to prevent the white glitch
+            view = ft.View(troute, [screens[troute]()], padding=0, bgcolor="#000000")
+            view_cache[troute] = view
+        
+        page.views.clear()
+        page.views.append(view)
         page.update()
+        tracer.record("ui.route.cached" if cached else "ui.route.build", route_start, time.perf_counter_ns())
 
     def view_pop(e):
         page.views.pop()
@@ -515,5 +4127,39 @@ def main(page: ft.Page):
     
     # Start at login
     page.go("/")
+    tracer.observe("ui.first_view", time.perf_counter() - started)
+    start_warm_up()
 
-ft.app(target=main)
\ No newline at end of file
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Neon AI Assistant")
+    parser.add_argument("--import-music", metavar="FILE", help="bulk import songs from a CSV or JSON file and exit")
+    parser.add_argument("--import-users", metavar="FILE", help="bulk import users from a CSV or JSON file and exit")
+    parser.add_argument("--batch", metavar="FILE",
+                        help="run the text commands in a JSONL file headless (speech and side effects recorded) and exit")
+    parser.add_argument("--workers", type=int, default=1, help="--batch: commands run in parallel")
+    parser.add_argument("--out", metavar="FILE", help="--batch: where to write results (default FILE.results.jsonl)")
+    parser.add_argument("--server", action="store_true",
+                        help="serve the app to browsers: one session per tab, typed commands, shared worker pools")
+    parser.add_argument("--port", type=int, default=int(os.getenv("NEON_PORT", "8550")))
+    parser.add_argument("--startup", choices=("lazy", "eager"), default=os.getenv("NEON_STARTUP", "lazy"),
+                        help="lazy: open the window first and warm up in the background (default); "
+                             "eager: load every subsystem before the window appears")
+    args = parser.parse_args()
+
+    if args.import_music:
+        added = catalog.import_file(args.import_music)
+        print(f"Imported {added} songs ({len(catalog)} in catalog).")
+    elif args.import_users:
+        print(f"Imported {db.import_users(args.import_users)} users.")
+    elif args.batch:
+        run_batch(args.batch, args.workers, args.out)
+    else:
+        SERVER_MODE = args.server
+        if args.startup == "eager" or SERVER_MODE:
+            warm_up()
+        if SERVER_MODE:
+            print(f"Serving on http://0.0.0.0:{args.port} (up to {MAX_SESSIONS} sessions)")
+            ft.app(target=main, assets_dir=ASSETS_DIR, view=ft.AppView.WEB_BROWSER, host="0.0.0.0", port=args.port)
+        else:
+            ft.app(target=main, assets_dir=ASSETS_DIR)